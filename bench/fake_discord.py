@@ -0,0 +1,61 @@
+import asyncio
+import itertools
+import time
+from collections import namedtuple
+
+SentMessage = namedtuple('SentMessage', ['id', 'channel', 'content', 'embed', 'files', 'file_bytes', 'sent_at'])
+
+_ids = itertools.count(1)
+
+
+class FakeChannel(object):
+    """
+    Stands in for a discord text channel, capturing every message sent to it instead of calling the Discord API.
+    """
+
+    def __init__(self, channel_id=None, latency=0.0):
+        """
+        :param latency: seconds each send waits, to stand in for the round trip to Discord.
+        """
+        self.id = channel_id or next(_ids)
+        self.latency = latency
+        self.sent = []
+
+    async def send(self, content=None, *, embed=None, file=None, files=None, **kwargs):
+        files = list(files or []) + ([file] if file else [])
+        # Read the attachments the same way discord.py does when it uploads them
+        file_bytes = sum(len(attachment.fp.read()) for attachment in files)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message = SentMessage(next(_ids), self, content, embed, files, file_bytes, time.perf_counter())
+        self.sent.append(message)
+        return message
+
+
+class FakeUser(object):
+    def __init__(self, user_id=None, name='benchmark'):
+        self.id = user_id or next(_ids)
+        self.name = name
+        self.display_name = name
+        self.mention = f'<@{self.id}>'
+        self.color = None
+        self.dm_channel = None
+
+    async def create_dm(self):
+        self.dm_channel = FakeChannel()
+        return self.dm_channel
+
+
+class FakeContext(object):
+    """
+    Minimal command context for calling command callbacks directly: ctx.send goes to a FakeChannel.
+    """
+
+    def __init__(self, author=None, channel=None, bot=None):
+        self.author = author or FakeUser()
+        self.channel = channel or FakeChannel()
+        self.bot = bot
+        self.guild = None
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
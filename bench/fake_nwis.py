@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import zlib
+
+import numpy as np
+from aiohttp import web
+
+# Days of synthetic history served when a request gives neither startDT nor period
+DEFAULT_PERIOD_DAYS = 30
+# First day of synthetic history, like a station's period of record the service never answers with earlier values
+HISTORY_START = np.datetime64('1910-10-01', 'D')
+
+
+def site_name(site_no):
+    return f'SYNTHETIC CREEK {site_no} NEAR BENCHMARK, UT'
+
+
+def synthetic_values(site_no, dates):
+    """
+    Returns repeatable daily CFS values for the given site: a seasonal snowmelt curve scaled per site with some
+    noise on top, so every run of a benchmark charts the same data.
+    :param dates: datetime64[D] array of the days to generate.
+    """
+    seed = zlib.crc32(str(site_no).encode('ascii'))
+    base = 20 + seed % 5000
+    day_of_year = (dates - dates.astype('datetime64[Y]')).astype(np.int64)
+    seasonal = 1 + 3 * np.exp(-((day_of_year - 150) / 35.0) ** 2)
+    # Noise derived from the day itself so overlapping requests agree on every value
+    days = dates.astype(np.int64)
+    noise = 0.9 + 0.2 * ((days * 2654435761 + seed) % 1000) / 1000
+    return np.round(base * seasonal * noise, 2)
+
+
+def _date_range(query, today):
+    """
+    Returns the datetime64[D] days a daily values request asks for, following the startDT, endDT and period
+    parameters of the USGS daily values service.
+    """
+    end = np.datetime64(query.get('endDT', str(today - datetime.timedelta(days=1))), 'D')
+    if 'startDT' in query:
+        start = max(np.datetime64(query['startDT'], 'D'), HISTORY_START)
+    else:
+        period = query.get('period', f'P{DEFAULT_PERIOD_DAYS}D')
+        start = end - np.timedelta64(int(period.strip('PD')) - 1, 'D')
+    return np.arange(start, end + np.timedelta64(1, 'D'), dtype='datetime64[D]')
+
+
+def _requested_sites(query):
+    sites = query.get('sites') or query.get('site') or ''
+    return [site for site in sites.split(',') if site]
+
+
+class FakeNwis(object):
+    """
+    Local stand-in for the USGS water services serving the daily values (RDB and WaterML-JSON) and site services
+    for any sites and periods, so reports can be benchmarked without touching waterservices.usgs.gov.
+    """
+
+    def __init__(self, recordings=None, delay=0.0, today=None, error_rate=0.0, stall_rate=0.0, stall=30.0):
+        """
+        :param recordings: optional directory of recorded daily values responses named <site_no>.rdb, served as is
+        in place of synthetic values for those sites.
+        :param delay: seconds each response waits before it's sent, to stand in for network latency.
+        :param today: date the synthetic data ends the day before, defaults to the real date.
+        :param error_rate: fraction of daily values requests answered with 503 Service Unavailable.
+        :param stall_rate: fraction of daily values requests that hang for `stall` seconds before being answered.
+        """
+        self.recordings = recordings
+        self.delay = delay
+        self.today = today or datetime.date.today()
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        # Seeded so a benchmark sees the same failures on every run
+        self._random = random.Random(0)
+        self.requests = 0
+        self.not_modified = 0
+        self.app = web.Application()
+        self.app.router.add_get('/nwis/dv/', self.daily_values)
+        self.app.router.add_get('/nwis/site/', self.sites)
+        self._runner = None
+        self.url = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        Starts serving on the given host and port, or a free port when port is 0.
+        :return: the base url to use in place of get_cfs_data.BASE_URL
+        """
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f'http://{host}:{port}/nwis'
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+        self._runner = None
+
+    def _recorded(self, site_no):
+        if self.recordings:
+            path = os.path.join(self.recordings, f'{site_no}.rdb')
+            if os.path.isfile(path):
+                with open(path, 'r', encoding='utf-8') as recording:
+                    return recording.read()
+
+    def _rdb_block(self, site_no, dates):
+        # Multi-site responses repeat the header for each site, just like the real service
+        values = synthetic_values(site_no, dates)
+        cutoff = np.datetime64(self.today, 'D') - np.timedelta64(120, 'D')
+        lines = [f'#    USGS {site_no} {site_name(site_no)}',
+                 '#',
+                 'agency_cd\tsite_no\tdatetime\t1234_00060_00003\t1234_00060_00003_cd',
+                 '5s\t15s\t20d\t14n\t10s']
+        lines.extend(f'USGS\t{site_no}\t{date}\t{value:g}\t{"P" if date >= cutoff else "A"}'
+                     for date, value in zip(dates, values))
+        return '\n'.join(lines)
+
+    def _json_series(self, site_no, dates):
+        values = synthetic_values(site_no, dates)
+        return {
+            'sourceInfo': {'siteName': site_name(site_no), 'siteCode': [{'value': site_no, 'agencyCode': 'USGS'}]},
+            'variable': {'variableCode': [{'value': '00060'}], 'unit': {'unitCode': 'ft3/s'}},
+            'values': [{'value': [{'value': f'{value:g}', 'qualifiers': ['P'], 'dateTime': f'{date}T00:00:00.000'}
+                                  for date, value in zip(dates, values)]}],
+        }
+
+    async def daily_values(self, request):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self._random.random() < self.error_rate:
+            return web.Response(status=503, text='Service Unavailable')
+        if self._random.random() < self.stall_rate:
+            await asyncio.sleep(self.stall)
+        sites = _requested_sites(request.query)
+        if not sites:
+            return web.Response(status=400, text='# //Error: a major filter (sites) must be given')
+        dates = _date_range(request.query, self.today)
+
+        if request.query.get('format', 'json').startswith('json'):
+            return web.json_response({'value': {'timeSeries': [self._json_series(site_no, dates)
+                                                                for site_no in sites]}})
+        blocks = [self._recorded(site_no) or self._rdb_block(site_no, dates) for site_no in sites]
+        body = '#\n# US Geological Survey\n# Synthetic daily values\n#\n' + '\n'.join(blocks) + '\n'
+        # Answer conditional requests like a server that supports revalidation would
+        etag = f'"{zlib.crc32(body.encode("utf-8")):08x}"'
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=body, content_type='text/plain', headers={'ETag': etag})
+
+    async def sites(self, request):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        state_cd = request.query.get('stateCd', 'UT').upper()
+        # Ten sites per state with site numbers derived from the state code so they don't clash across states
+        prefix = zlib.crc32(state_cd.encode('ascii')) % 90 + 10
+        lines = ['agency_cd\tsite_no\tstation_nm\tsite_tp_cd\thuc_cd', '5s\t15s\t50s\t7s\t16s']
+        lines.extend(f'USGS\t{prefix}{i:06d}\t{site_name(f"{prefix}{i:06d}")}\tST\t1407000{i % 10}'
+                     for i in range(10))
+        return web.Response(text='#\n# Synthetic site inventory\n#\n' + '\n'.join(lines) + '\n',
+                            content_type='text/plain')
+
+
+async def _serve(port, recordings, delay, error_rate, stall_rate):
+    server = FakeNwis(recordings=recordings, delay=delay, error_rate=error_rate, stall_rate=stall_rate)
+    print(f'Serving a fake USGS water service at {await server.start(port=port)}')
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the USGS water services.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--recordings', help='directory of recorded <site_no>.rdb daily values responses')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='fraction of requests that hang for 30s')
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args.port, args.recordings, args.delay, args.error_rate, args.stall_rate))
+    except KeyboardInterrupt:
+        pass
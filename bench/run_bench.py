@@ -0,0 +1,204 @@
+"""
+Times each step of a station report against the local fake USGS service and a fake Discord channel, without any
+network access. Run from the repository root:
+
+    python -m bench.run_bench --stations 1 10 100 --repeat 10
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import discord
+import numpy as np
+from PIL import Image
+
+# Importing lib.db builds the database, so the throwaway one has to be chosen first for the bot's own database to
+# never be touched
+_directory = tempfile.TemporaryDirectory()
+os.environ['STREAMFLOW_DB_PATH'] = os.path.join(_directory.name, 'bench.db')
+
+from lib.db import db
+from lib.utils import chart_cache, get_cfs_data, graph_cfs, png_chart, rdb, render_pool
+from lib.utils.outbox import Outbox
+from lib.utils.series import StationSeries
+from .fake_discord import FakeChannel, FakeUser
+from .fake_nwis import FakeNwis
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ('fetch', 'parse', 'chart', 'png', 'deliver', 'report')
+# First synthetic site number, the benchmark's stations are numbered upwards from here
+FIRST_SITE = 10000000
+
+
+def peak_rss_mb(who='self'):
+    """
+    Returns the peak resident set size in megabytes of this process ('self') or of its largest finished or waited
+    for child ('children'), or None where the platform doesn't report it.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # Linux reports kilobytes, macOS bytes
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def sites_for(count):
+    return [FIRST_SITE + i for i in range(count)]
+
+
+async def fetch(sites, days):
+    start = datetime.date.today() - datetime.timedelta(days=days)
+    url = f'{get_cfs_data.BASE_URL}/dv/?format=rdb&parameterCd=00060&startDT={start:%Y-%m-%d}' \
+          f'&sites={",".join(str(site) for site in sites)}'
+    async with get_cfs_data.get_session().get(url) as response:
+        return await response.read()
+
+
+def parse(body):
+    return [StationSeries(series.site_no, series.site_name, series.dates, series.values, series.qualifiers)
+            for series in rdb.parse_rdb(body.decode('utf-8').splitlines())]
+
+
+def chart(series_list, backend):
+    if backend == 'bokeh':
+        return graph_cfs.create_line_charts(series_list)
+    charts = []
+    for series in series_list:
+        image = Image.new('RGB', (graph_cfs.CHART_WIDTH, graph_cfs.CHART_HEIGHT), png_chart.BACKGROUND)
+        png_chart.draw_line_chart(image, (0, 0, graph_cfs.CHART_WIDTH, graph_cfs.CHART_HEIGHT), series.site_name,
+                                  series.dates, series.values)
+        charts.append(image)
+    return charts
+
+
+def export(charts, backend):
+    if backend == 'bokeh':
+        return [graph_cfs.export_png_bytes(fig) for fig in charts]
+    return [png_chart.to_png(image) for image in charts]
+
+
+async def deliver(outbox, user, pngs):
+    channel = FakeChannel()
+    await outbox.send(channel, user.id, content='Station report',
+                      files=[discord.File(io.BytesIO(png), filename=f'{i}_report.png') for i, png in enumerate(pngs)])
+    return channel
+
+
+async def report(outbox, user, sites, days, backend):
+    """
+    The whole report path the bot takes: fetch and store through get_cfs_data, render in the worker pool and send
+    through the outbox. Stored values, cached responses and cached charts are cleared first so every run starts
+    cold.
+    """
+    await db.execute('DELETE FROM observations')
+    await db.execute('DELETE FROM http_cache')
+    chart_cache.cache = chart_cache.ChartCache(32 * 1024 * 1024)
+    series_list = await get_cfs_data.get_daily_site_data(sites, days=days)
+    pngs = await render_pool.render_line_charts(series_list, backend=backend)
+    return await deliver(outbox, user, pngs)
+
+
+async def run_once(count, days, backend, outbox, user):
+    sites = sites_for(count)
+    timings = {}
+
+    started = time.perf_counter()
+    body = await fetch(sites, days)
+    timings['fetch'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    series_list = parse(body)
+    timings['parse'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    charts = chart(series_list, backend)
+    timings['chart'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    pngs = export(charts, backend)
+    timings['png'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    channel = await deliver(outbox, user, pngs)
+    timings['deliver'] = time.perf_counter() - started
+    assert sum(len(message.files) for message in channel.sent) == count
+
+    started = time.perf_counter()
+    channel = await report(outbox, user, sites, days, backend)
+    timings['report'] = time.perf_counter() - started
+    assert sum(len(message.files) for message in channel.sent) == count
+    return timings
+
+
+async def run(counts, repeat, warmup, days, backend, workers, delay):
+    server = FakeNwis(delay=delay)
+    get_cfs_data.BASE_URL = await server.start()
+    render_pool.start(workers=workers, backend=backend)
+    outbox = Outbox()
+    user = FakeUser()
+    results = []
+    try:
+        for count in counts:
+            for _ in range(warmup):
+                await run_once(count, days, backend, outbox, user)
+            runs = [await run_once(count, days, backend, outbox, user) for _ in range(repeat)]
+            result = {'stations': count, 'peak_rss_mb': peak_rss_mb()}
+            for stage in STAGES:
+                samples = np.array([timings[stage] for timings in runs]) * 1000
+                result[stage] = {'p50_ms': float(np.percentile(samples, 50)),
+                                 'p95_ms': float(np.percentile(samples, 95))}
+            results.append(result)
+            print_result(result)
+    finally:
+        await get_cfs_data.close_session()
+        await server.stop()
+        # Wait for the workers to exit so their peak memory is counted
+        render_pool.shutdown(wait=True)
+    return results
+
+
+def print_result(result):
+    rss = result['peak_rss_mb']
+    print(f'{result["stations"]:>4} stations  peak RSS {f"{rss:.0f} MB" if rss is not None else "n/a"}')
+    for stage in STAGES:
+        print(f'    {stage:<8} p50 {result[stage]["p50_ms"]:>9.1f} ms   p95 {result[stage]["p95_ms"]:>9.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark station reports against a local fake USGS service.')
+    parser.add_argument('--stations', type=int, nargs='+', default=[1, 10, 100],
+                        help='station counts to benchmark (default 1 10 100)')
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs per station count')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs before the timed ones')
+    parser.add_argument('--days', type=int, default=30, help='days of values per station')
+    parser.add_argument('--backend', choices=graph_cfs.BACKENDS, default='pillow')
+    parser.add_argument('--workers', type=int, default=None, help='chart rendering processes')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds of simulated latency per USGS request')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(run(args.stations, args.repeat, args.warmup, args.days, args.backend,
+                                  args.workers, args.delay))
+    finally:
+        db.close()
+        _directory.cleanup()
+
+    print(f'Peak RSS of render workers: {peak_rss_mb("children") or 0:.0f} MB')
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 CREATE TABLE IF NOT EXISTS guilds (
     GuildID integer PRIMARY KEY,
-    Prefix text DEFAULT "!"
+    Prefix text DEFAULT "!",
+    ChannelID integer
 );
 
 CREATE TABLE IF NOT EXISTS users (
@@ -18,4 +19,75 @@ CREATE TABLE IF NOT EXISTS subscriptions (
     UNIQUE(UserID, StationID)
     FOREIGN KEY(UserID) REFERENCES users(UserID) ON DELETE CASCADE,
     FOREIGN KEY(StationID) REFERENCES stations(StationID) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS observations (
+    StationID integer,
+    ObsDate text,
+    Value real,
+    Qualifiers text,
+    PRIMARY KEY(StationID, ObsDate)
+) WITHOUT ROWID;
+
+
+CREATE TABLE IF NOT EXISTS sites (
+    StationID integer PRIMARY KEY,
+    StationName text,
+    StateCd text,
+    HucCd text,
+    SiteType text
+);
+
+CREATE INDEX IF NOT EXISTS sites_state ON sites (StateCd);
+
+CREATE INDEX IF NOT EXISTS sites_huc ON sites (HucCd);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS sites_fts USING fts5 (
+    StationName,
+    content='sites',
+    content_rowid='StationID'
+);
+
+CREATE TABLE IF NOT EXISTS alerts (
+    AlertID integer PRIMARY KEY,
+    UserID integer,
+    StationID integer,
+    Direction text,
+    Threshold real,
+    Triggered integer DEFAULT 0,
+    FOREIGN KEY(UserID) REFERENCES users(UserID) ON DELETE CASCADE,
+    FOREIGN KEY(StationID) REFERENCES stations(StationID) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS alerts_station ON alerts (StationID, Direction, Threshold);
+
+CREATE TABLE IF NOT EXISTS http_cache (
+    CacheKey text PRIMARY KEY,
+    Body blob,
+    ETag text,
+    LastModified text,
+    FetchedAt real,
+    ExpiresAt real
+);
+
+CREATE TABLE IF NOT EXISTS coverage (
+    StationID integer PRIMARY KEY,
+    FirstDate text,
+    FOREIGN KEY(StationID) REFERENCES stations(StationID) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS flow_percentiles (
+    StationID integer,
+    DayOfYear integer,
+    Years integer,
+    Quantiles blob,
+    PRIMARY KEY(StationID, DayOfYear)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS flow_percentiles_status (
+    StationID integer PRIMARY KEY,
+    ThroughDate text,
+    FirstDate text,
+    ProvisionalFrom text,
+    ProvisionalDigest text
+);
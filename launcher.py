@@ -1,9 +1,13 @@
 import os
+import time
 
-from lib.bot import bot
+if __name__ == '__main__':
+    started_at = time.perf_counter()
+    # Imported here so the spawned chart rendering workers, which re-import this module, don't build a bot of their own
+    from lib.bot import bot
 
-temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
-if not os.path.exists(temp_dir):
-    os.mkdir(temp_dir)
+    temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
+    if not os.path.exists(temp_dir):
+        os.mkdir(temp_dir)
 
-bot.run()
+    bot.run(started_at)
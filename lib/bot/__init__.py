@@ -2,17 +2,22 @@ __version__ = "0.1.2"
 
 import configparser
 import os
+import time
 import pytz
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from asyncio import sleep
+from apscheduler.triggers.cron import CronTrigger
+from asyncio import Event
 from datetime import datetime
 from discord import Embed, HTTPException, Forbidden
 from discord import Intents
-from discord.ext.commands import Bot as BotBase, CommandNotFound, BadArgument, CommandOnCooldown, when_mentioned_or, \
+from discord.ext.commands import AutoShardedBot as BotBase, CommandNotFound, BadArgument, CommandOnCooldown, when_mentioned_or, \
     Context
 
-from ..db import db
+from ..db import db, guild_settings
+from ..utils import chart_cache, fetch_policy, flow_stats, get_cfs_data, http_cache, metrics, prefetch, render_pool, \
+    site_inventory
+from ..utils.outbox import Outbox
 
 OWNER_IDS = [208449015015145472]
 COGS = [path[:-3] for path in os.listdir('./lib/cogs') if path[-3:] == '.py']
@@ -22,56 +27,102 @@ config.read('./lib/bot/settings/bot.ini')
 
 
 def get_prefix(bot, message):
-    prefix = db.field("SELECT Prefix FROM guilds WHERE GuildID = ?", message.guild.id)
+    prefix = guild_settings.prefix(message.guild.id) if message.guild else guild_settings.DEFAULT_PREFIX
     return when_mentioned_or(prefix)(bot, message)
 
 
 class Ready(object):
     def __init__(self):
+        self.event = Event()
         for cog in COGS:
             setattr(self, cog, False)
 
     def ready_up(self, cog):
         setattr(self, cog, True)
         print(f'\t{cog} ready')
+        if self.all_ready:
+            self.event.set()
 
     @property
     def all_ready(self):
         return all([getattr(self, cog) for cog in COGS])
 
+    async def wait(self):
+        await self.event.wait()
+
 
 class Bot(BotBase):
     def __init__(self):
         self.VERSION = __version__
         self.TOKEN = None
         self.ready = False
+        self.started_at = None
         self.cogs_ready = Ready()
         self.guild_id = None
         self.channel_id = None
-        self.guild = None
         self.stdout = None
         self.scheduler = AsyncIOScheduler()
-
-        db.autosave(self.scheduler)
+        self.outbox = Outbox(rate=config['DEFAULT'].getint('channel_rate', fallback=5),
+                             per=config['DEFAULT'].getfloat('channel_rate_seconds', fallback=5.0))
+
+        db.configure(flush_interval=config['DEFAULT'].getint('db_flush_ms', fallback=50) / 1000,
+                     flush_size=config['DEFAULT'].getint('db_flush_size', fallback=100))
+        # USGS publishes the previous day's daily values by usgs_publish_hour UTC and late values keep coming in for
+        # usgs_publish_window hours, so by default the cache is warmed once that window has closed
+        publish_end = (config['DEFAULT'].getint('usgs_publish_hour', fallback=10)
+                       + config['DEFAULT'].getint('usgs_publish_window', fallback=6)) % 24
+        self.scheduler.add_job(self.prefetch_subscriptions,
+                               CronTrigger(hour=config['DEFAULT'].get('prefetch_hour', str(publish_end)),
+                                           minute=config['DEFAULT'].get('prefetch_minute', '0'), timezone=pytz.utc),
+                               misfire_grace_time=3600, coalesce=True)
+        self.scheduler.add_job(http_cache.prune, CronTrigger(hour=4), misfire_grace_time=86400, coalesce=True)
+        # Stations come and go slowly so the site index only needs refreshing weekly
+        self.scheduler.add_job(site_inventory.import_sites,
+                               CronTrigger(day_of_week=config['DEFAULT'].get('site_import_day', 'sun'), hour=3),
+                               misfire_grace_time=86400, coalesce=True)
+
+        # Leave both unset to run every shard in this process. Set them to split the shards across processes.
+        shard_count = config['DEFAULT'].getint('shard_count', fallback=None)
+        shard_ids = config['DEFAULT'].get('shard_ids')
 
         super().__init__(
             command_prefix=get_prefix,
             owner_ids=OWNER_IDS,
             intents=Intents.all(),
+            shard_count=shard_count,
+            shard_ids=[int(shard_id) for shard_id in shard_ids.split(',')] if shard_ids else None,
         )
 
     def get_guild_channel(self):
-        self.guild_id = int(config['DEFAULT']['guild'])
-        self.channel_id = int(config['DEFAULT']['channel'])
+        # Both are optional. The channel receives the bot's status messages and, along with the guild, seeds that
+        # guild's command channel for setups from before the bot supported multiple guilds.
+        self.guild_id = config['DEFAULT'].getint('guild', fallback=None)
+        self.channel_id = config['DEFAULT'].getint('channel', fallback=None)
 
     def setup(self):
         self.get_guild_channel()
+        http_cache.configure(publish_hour=config['DEFAULT'].getint('usgs_publish_hour', fallback=10),
+                             publish_window_hours=config['DEFAULT'].getint('usgs_publish_window', fallback=6))
+        hedge_ms = config['DEFAULT'].getint('usgs_hedge_ms', fallback=0)
+        fetch_policy.configure(timeout=config['DEFAULT'].getfloat('usgs_timeout', fallback=8.0),
+                               retries=config['DEFAULT'].getint('usgs_retries', fallback=2),
+                               hedge_delay=hedge_ms / 1000 if hedge_ms else None,
+                               failure_threshold=config['DEFAULT'].getint('usgs_breaker_failures', fallback=5),
+                               reset_timeout=config['DEFAULT'].getfloat('usgs_breaker_reset', fallback=60.0),
+                               history_timeout=config['DEFAULT'].getfloat('usgs_history_timeout', fallback=120.0))
+        chart_cache.configure(max_mb=config['DEFAULT'].getint('chart_cache_mb', fallback=32),
+                              disk_max_mb=config['DEFAULT'].getint('chart_disk_cache_mb', fallback=256))
+        render_pool.configure(downsample_method=config['DEFAULT'].get('downsample_method', 'minmax'))
         for cog in COGS:
             self.load_extension(f'lib.cogs.{cog}')
 
         print('Setup complete')
 
-    def run(self):
+    def run(self, started_at=None):
+        """
+        :param started_at: time.perf_counter() reading taken when the process started, startup is timed from there.
+        """
+        self.started_at = started_at or time.perf_counter()
         print('Running setup...')
         self.setup()
 
@@ -86,11 +137,21 @@ class Bot(BotBase):
 
         if ctx.command is not None and ctx.guild is not None:
             if self.ready:
-                await self.invoke(ctx)
+                with metrics.span(f'command_{ctx.command.qualified_name}'):
+                    await self.invoke(ctx)
             else:
                 await ctx.send("I'm not ready to recieve commands. Please wait a few seconds.")
 
+    async def close(self):
+        await metrics.stop_server()
+        await get_cfs_data.close_session()
+        render_pool.shutdown()
+        await super().close()
+        db.close()
+
     async def on_connect(self):
+        if not self.ready:
+            metrics.observe('startup_connect', time.perf_counter() - self.started_at)
         print('\tbot connected')
 
     async def on_disconnect(self):
@@ -99,7 +160,7 @@ class Bot(BotBase):
     async def on_error(self, err, *args, **kwargs):
         if err == "on_command_error":
             await args[0].send("[!] Something went wrong with that command.")
-        else:
+        elif self.stdout is not None:
             await self.stdout.send('[!] An error occurred.')
 
         raise
@@ -123,61 +184,101 @@ class Bot(BotBase):
 
     async def on_ready(self):
         if not self.ready:
-            self.guild = self.get_guild(self.guild_id)
-            self.stdout = self.get_channel(self.channel_id)
+            self.stdout = self.get_channel(self.channel_id) if self.channel_id else None
             self.scheduler.start()
+            if (metrics_port := config['DEFAULT'].getint('metrics_port', fallback=None)) is not None:
+                await metrics.start_server(metrics_port, host=config['DEFAULT'].get('metrics_host', '127.0.0.1'))
 
-            self.update_db()
-
-            mst_tz = pytz.timezone('MST')  # Mountain Standard Time
-            current_time = datetime.now().astimezone(mst_tz)
-            embed = Embed(title='Now online!',
-                          description='A bot to monitor your favorite rivers and streams.',
-                          color=0x99CCFF,
-                          timestamp=current_time)
-            updates = [
-                '01/19/2021: Multi-station reports now also include the latest CFS values for each station',
-                '01/18/2021 : `!report` command now returns a graph for all of the users subscriptions',
-            ]
-            fields = [('Version', self.VERSION, True),
-                      ('Bot Amazingness Level', 'Maximum', True),
-                      ('Data Source', 'USGS National Water Information System (https://waterdata.usgs.gov)', False),
-                      ('Updates', '\n'.join([update for update in updates]), False)]
-            embed.set_author(name='Streamflow Grapher Bot', icon_url=self.guild.icon_url)
-            for name, value, inline in fields:
-                embed.add_field(name=name, value=value, inline=inline)
-            await self.stdout.send(embed=embed)
+            # Only what commands depend on happens before the bot is ready, the rest is left to warm_up
+            await self.update_guilds()
+            await guild_settings.load()
+            if self.guild_id and self.channel_id and guild_settings.get(self.guild_id, 'ChannelID') is None:
+                await guild_settings.update(self.guild_id, ChannelID=self.channel_id)
 
             print('\twaiting for cogs...')
-            while not self.cogs_ready.all_ready:
-                await sleep(0.5)
+            await self.cogs_ready.wait()
 
             self.ready = True
-            print('\tbot ready!')
+            startup = time.perf_counter() - self.started_at
+            metrics.observe('startup_ready', startup)
+            print(f'\tbot ready in {startup:.1f}s!')
+            self.scheduler.add_job(self.warm_up)
         else:
             print('Bot reconnected.')
 
-    async def on_message(self, message):
-        if not message.author.bot and message.channel.id == self.channel_id:
-            await self.process_commands(message)
-
-    def update_db(self):
-        db.multiexec('INSERT OR IGNORE INTO guilds (GuildID) VALUES (?)',
-                     ((guild.id,) for guild in self.guilds))
-
-        db.multiexec('INSERT OR IGNORE INTO users (UserID) VALUES (?)',
-                     ((member.id,) for member in self.guild.members if not member.bot))
+    async def warm_up(self):
+        """
+        Starts everything that can wait until the bot is already answering commands.
+        """
+        render_workers = config['DEFAULT'].getint('render_workers', fallback=None)
+        render_pool.start(workers=render_workers, backend=config['DEFAULT'].get('chart_backend', 'pillow'))
+        await self.update_users()
+        if not await site_inventory.index_size():
+            self.scheduler.add_job(site_inventory.import_sites)
+        await self.announce()
+
+    async def announce(self):
+        if self.stdout is None:
+            return
+
+        mst_tz = pytz.timezone('MST')  # Mountain Standard Time
+        current_time = datetime.now().astimezone(mst_tz)
+        embed = Embed(title='Now online!',
+                      description='A bot to monitor your favorite rivers and streams.',
+                      color=0x99CCFF,
+                      timestamp=current_time)
+        updates = [
+            '01/19/2021: Multi-station reports now also include the latest CFS values for each station',
+            '01/18/2021 : `!report` command now returns a graph for all of the users subscriptions',
+        ]
+        fields = [('Version', self.VERSION, True),
+                  ('Bot Amazingness Level', 'Maximum', True),
+                  ('Data Source', 'USGS National Water Information System (https://waterdata.usgs.gov)', False),
+                  ('Updates', '\n'.join([update for update in updates]), False)]
+        embed.set_author(name='Streamflow Grapher Bot', icon_url=self.user.avatar_url)
+        for name, value, inline in fields:
+            embed.add_field(name=name, value=value, inline=inline)
+        await self.stdout.send(embed=embed)
 
-        to_remove = []
-        stored_members = db.column('SELECT UserID from users')
-        for id_ in stored_members:
-            if not self.guild.get_member(id_):
-                to_remove.append(id_)
+    async def on_message(self, message):
+        if message.author.bot or message.guild is None:
+            return
 
-        db.multiexec('DELETE FROM users WHERE UserID = ?',
-                     ((id_,) for id_ in to_remove))
+        # Guilds without a command channel accept commands in any channel
+        channel_id = guild_settings.get(message.guild.id, 'ChannelID')
+        if channel_id is None or message.channel.id == channel_id:
+            await self.process_commands(message)
 
-        db.commit()
+    async def prefetch_subscriptions(self):
+        station_ids = await db.column('SELECT DISTINCT StationID FROM subscriptions')
+        await prefetch.warm_stations(station_ids,
+                                     chunk_size=config['DEFAULT'].getint('prefetch_chunk_size', fallback=100),
+                                     concurrency=config['DEFAULT'].getint('prefetch_concurrency', fallback=4),
+                                     backend=config['DEFAULT'].get('chart_backend', 'pillow'))
+        # Folds the values just fetched into the day of year percentiles
+        await flow_stats.refresh(station_ids)
+
+    async def update_guilds(self):
+        await db.multiexec('INSERT OR IGNORE INTO guilds (GuildID) VALUES (?)',
+                           ((guild.id,) for guild in self.guilds))
+
+    async def update_users(self):
+        member_ids = {member.id for guild in self.guilds for member in guild.members if not member.bot}
+        await db.multiexec('INSERT OR IGNORE INTO users (UserID) VALUES (?)', ((id_,) for id_ in member_ids))
+
+        # Only a process running every shard sees every guild, so only it can tell who has left them all
+        if self.shard_ids is not None:
+            return
+
+        # Remove users who are no longer in any guild as one set difference against a temp table of current members.
+        # Every write runs in order on the same connection so the temp table is visible to the statements after it.
+        await db.execute('CREATE TEMP TABLE IF NOT EXISTS current_members (UserID integer PRIMARY KEY)', wait=False)
+        await db.execute('DELETE FROM temp.current_members', wait=False)
+        await db.multiexec('INSERT INTO temp.current_members (UserID) VALUES (?)', ((id_,) for id_ in member_ids),
+                           wait=False)
+        await db.execute('DELETE FROM users WHERE UserID NOT IN (SELECT UserID FROM temp.current_members)',
+                         wait=False)
+        await db.execute('DROP TABLE temp.current_members')
 
 
 bot = Bot()
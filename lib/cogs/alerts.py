@@ -0,0 +1,120 @@
+import asyncio
+import logging
+
+from apscheduler.triggers.interval import IntervalTrigger
+from discord import Embed
+from discord.ext.commands import Cog, command, BucketType, cooldown
+
+from ..bot import config
+from ..db import db
+from ..utils import alerts
+from ..utils.get_cfs_data import get_station_name
+from ..utils.series import format_cfs
+
+# How often the latest values of every alerted station are fetched and the alerts evaluated
+ALERT_POLL_MINUTES = config['DEFAULT'].getint('alert_poll_minutes', fallback=60)
+MAX_ALERTS_PER_USER = 25
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to debug
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+
+# create formatter
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# add formatter to ch
+ch.setFormatter(formatter)
+
+# add ch to logger
+logger.addHandler(ch)
+
+
+class Alerts(Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        # A poll marks the alerts it fires as triggered, so when the shards are split across processes only the one
+        # running shard 0 polls, otherwise the processes would race to fire, and send, the same alerts
+        if self.bot.shard_ids is None or 0 in self.bot.shard_ids:
+            self.bot.scheduler.add_job(self.check_alerts, IntervalTrigger(minutes=ALERT_POLL_MINUTES),
+                                       coalesce=True, max_instances=1)
+
+    @command(name='add_alert', aliases=['alert'])
+    @cooldown(4, 45, BucketType.user)
+    async def add_alert(self, ctx, station: int, direction: str, threshold: float):
+        """Sends you a direct message when a station's flow goes above or below the given CFS value,
+        e.g. `add_alert 09234500 above 5000`."""
+        direction = direction.lower()
+        if direction not in alerts.DIRECTIONS:
+            await ctx.send(f'The direction must be one of: {", ".join(alerts.DIRECTIONS)}.')
+            return
+
+        if await db.field('SELECT COUNT(*) FROM alerts WHERE UserID = ?', ctx.author.id) >= MAX_ALERTS_PER_USER:
+            await ctx.send(f'You can have at most {MAX_ALERTS_PER_USER} alerts. Remove one with remove_alert first.')
+            return
+
+        station_name = await get_station_name(station)
+        if not station_name:
+            await ctx.send(f'Unable to find matching station with ID of {station}.')
+            return
+
+        logger.debug(f'{ctx.author.display_name} added an alert for station {station} {direction} {threshold}')
+        await db.execute('INSERT INTO alerts (UserID, StationID, Direction, Threshold) VALUES (?, ?, ?, ?)',
+                         ctx.author.id, station, direction, threshold)
+        await ctx.send(f'{ctx.author.display_name} will be notified when {station_name} ({station}) flows '
+                       f'{direction} {format_cfs(threshold)} CFS.')
+
+    @command(name='list_alerts', aliases=['alerts'])
+    @cooldown(3, 30, BucketType.user)
+    async def list_alerts(self, ctx):
+        rows = await db.records('SELECT AlertID, alerts.StationID, StationName, Direction, Threshold FROM alerts '
+                                'INNER JOIN stations ON stations.StationID = alerts.StationID '
+                                'WHERE UserID = ? ORDER BY AlertID', ctx.author.id)
+        if not rows:
+            await ctx.send(f'{ctx.author.mention} You have no flow alerts. Add one with the add_alert command.')
+            return
+
+        embed = Embed(title='Flow Alerts', description=f'{ctx.author.mention} Your flow alerts',
+                      color=ctx.author.color)
+        embed.add_field(name="Alert ID", value='\n'.join([str(row[0]) for row in rows]))
+        embed.add_field(name="Station",
+                        value='\n'.join([f'{row[2][:30]} ({row[1]})' for row in rows]))
+        embed.add_field(name="Condition", value='\n'.join([f'{row[3]} {format_cfs(row[4])}' for row in rows]))
+        await ctx.send(embed=embed)
+
+    @command(name='remove_alert', aliases=['delete_alert'])
+    async def remove_alert(self, ctx, alert_id: int):
+        if not await db.field('SELECT 1 FROM alerts WHERE AlertID = ? AND UserID = ?', alert_id, ctx.author.id):
+            await ctx.send(f'You don\'t have an alert with ID {alert_id}.')
+            return
+
+        await db.execute('DELETE FROM alerts WHERE AlertID = ?', alert_id)
+        await ctx.send(f'Removed alert {alert_id}.')
+
+    async def notify(self, alert):
+        # Users only sharing guilds on shards of another process aren't cached here
+        user = self.bot.get_user(alert.user_id) or await self.bot.fetch_user(alert.user_id)
+        channel = user.dm_channel or await user.create_dm()
+        await self.bot.outbox.send(channel, alert.user_id,
+                                   content=f'{alert.station_name} ({alert.station_id}) is now flowing at '
+                                           f'{format_cfs(alert.value)} CFS, {alert.direction} your alert of '
+                                           f'{format_cfs(alert.threshold)} CFS.')
+
+    async def check_alerts(self):
+        fired = await alerts.poll()
+        logger.debug(f'{len(fired)} flow alerts fired')
+        results = await asyncio.gather(*(self.notify(alert) for alert in fired), return_exceptions=True)
+        for alert, result in zip(fired, results):
+            if isinstance(result, Exception):
+                logger.warning(f'Unable to notify user {alert.user_id} of alert {alert.alert_id}: {result!r}')
+
+    @Cog.listener()
+    async def on_ready(self):
+        if not self.bot.ready:
+            self.bot.cogs_ready.ready_up("alerts")
+
+
+def setup(bot):
+    bot.add_cog(Alerts(bot))
@@ -1,6 +1,14 @@
-from discord.ext.commands import Cog, command, has_permissions, CheckFailure
+from typing import Optional
 
-from ..db import db
+from discord import Embed, TextChannel
+from discord.ext.commands import Cog, command, has_permissions, is_owner, CheckFailure
+
+from ..db import guild_settings
+from ..utils import metrics
+
+
+def format_ms(seconds):
+    return f'{seconds * 1000:,.1f} ms' if seconds is not None else 'n/a'
 
 
 class Misc(Cog):
@@ -13,7 +21,7 @@ class Misc(Cog):
         if len(new) > 5:
             await ctx.send("The prefix cannot use more than five characters.")
         else:
-            db.execute("UPDATE guilds SET Prefix = ? WHERE GuildID = ?", new, ctx.guild.id)
+            await guild_settings.update(ctx.guild.id, Prefix=new)
             await ctx.send(f'Prefix is now set to {new}')
 
     @change_prefix.error
@@ -21,6 +29,36 @@ class Misc(Cog):
         if isinstance(exc, CheckFailure):
             await ctx.send("You need the Manage Server permission to do that.")
 
+    @command(name="command_channel")
+    @has_permissions(manage_guild=True)
+    async def change_command_channel(self, ctx, channel: Optional[TextChannel]):
+        """Limits the bot to commands sent in the given channel. Leave out the channel to accept commands anywhere."""
+        await guild_settings.update(ctx.guild.id, ChannelID=channel.id if channel else None)
+        if channel:
+            await ctx.send(f'Commands are now only accepted in {channel.mention}')
+        else:
+            await ctx.send('Commands are now accepted in every channel')
+
+    @change_command_channel.error
+    async def change_command_channel_error(self, ctx, exc):
+        if isinstance(exc, CheckFailure):
+            await ctx.send("You need the Manage Server permission to do that.")
+
+    @command(name="stats", hidden=True)
+    @is_owner()
+    async def show_stats(self, ctx):
+        """Shows the latency of each part of the bot since it started, along with its counters."""
+        histograms, counters = metrics.snapshot()
+        embed = Embed(title='Bot statistics', description='Latency percentiles over the most recent '
+                                                          f'{metrics.RESERVOIR_SIZE} timings of each span')
+        # Embeds take at most 25 fields, one is kept for the counters
+        for name, count, p50, p95 in histograms[:24]:
+            embed.add_field(name=name, value=f'{count:,} timed\np50 {format_ms(p50)}\np95 {format_ms(p95)}')
+        if counters:
+            embed.add_field(name='Counters', value='\n'.join(f'{name}: {value:,}' for name, value in counters)[:1024],
+                            inline=False)
+        await ctx.send(embed=embed)
+
     @Cog.listener()
     async def on_ready(self):
         if not self.bot.ready:
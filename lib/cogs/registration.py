@@ -1,6 +1,6 @@
 from discord.ext.commands import Cog
 
-from ..db import db
+from ..db import db, guild_settings
 
 
 class Registration(Cog):
@@ -12,14 +12,27 @@ class Registration(Cog):
         if not self.bot.ready:
             self.bot.cogs_ready.ready_up("registration")
 
+    @Cog.listener()
+    async def on_guild_join(self, guild):
+        await guild_settings.add_guild(guild.id)
+        print(f"Joined {guild.name}. Guild ({guild.id}) added to database.")
+
     @Cog.listener()
     async def on_member_join(self, member):
-        db.execute("INSERT INTO users (UserID) VALUES (?)", member.id)
+        await db.execute("INSERT OR IGNORE INTO users (UserID) VALUES (?)", member.id)
         print(f"Registered {member.display_name} in {member.guild.name}.")
 
     @Cog.listener()
     async def on_member_remove(self, member):
-        db.execute("DELETE FROM users WHERE UserID = ?", member.id)
+        # Only a process running every shard sees every guild, so only it can tell who has left them all
+        if self.bot.shard_ids is not None:
+            return
+
+        # Users are shared between guilds so keep them while they're still in another guild
+        if any(guild.get_member(member.id) for guild in self.bot.guilds if guild.id != member.guild.id):
+            return
+
+        await db.execute("DELETE FROM users WHERE UserID = ?", member.id)
         print(f"{member.display_name} has left {member.guild.name}. User ({member.id}) removed from database.")
 
 
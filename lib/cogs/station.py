@@ -1,16 +1,38 @@
+import asyncio
+import io
 import logging
 import datetime
+import re
 from typing import Optional
 
 import discord
-from bokeh.io import export_png
 from discord import Embed
-from discord.ext.commands import Cog, command, BucketType, cooldown
+from discord.ext.commands import Cog, command, BucketType, cooldown, is_owner
+from discord.ext.menus import MenuPages, ListPageSource
 
-from ..bot import get_prefix
+from ..bot import config, get_prefix
 from ..db import db
-from ..utils.get_cfs_data import get_daily_site_data, get_latest_values, get_station_name
-from ..utils.graph_cfs import create_line_charts
+from ..utils import flow_stats
+from ..utils.get_cfs_data import RECORD_START, get_daily_site_data, get_latest_values, get_station_name
+from ..utils.render_pool import render_line_charts, render_report_pages
+from ..utils.series import format_cfs
+from ..utils.site_inventory import STATE_CODES, find_sites, import_sites
+
+# 'pillow' renders charts in process, 'bokeh' exports them through a headless browser
+CHART_BACKEND = config['DEFAULT'].get('chart_backend', 'pillow')
+# 'menu' pages through a multi-station report one station at a time, rendering each chart when its page is shown.
+# 'composite' tiles it into pages of small charts, 'separate' sends one chart per station.
+MULTI_REPORT_MODE = config['DEFAULT'].get('multi_report_mode', 'menu')
+# Private channel the charts of report menus are uploaded to so the menu's pages can show them. When unset each chart
+# is sent to the report's own channel when its page is first shown.
+REPORT_CHART_CHANNEL = config['DEFAULT'].getint('report_chart_channel', fallback=None)
+# Seconds a report menu keeps reacting to page turns
+REPORT_MENU_TIMEOUT = config['DEFAULT'].getfloat('report_menu_timeout', fallback=300.0)
+REPORT_PANELS_PER_PAGE = config['DEFAULT'].getint('report_panels_per_page', fallback=6)
+REPORT_PANEL_COLUMNS = config['DEFAULT'].getint('report_panel_columns', fallback=2)
+# Report periods are a count of days, weeks, months or years, e.g. 30d or 10y
+PERIOD_PATTERN = re.compile(r'(\d+)([dwmy])')
+PERIOD_DAYS = {'d': 1, 'w': 7, 'm': 30, 'y': 365}
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -29,24 +51,176 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-def subscribe_user(member, station_id):
+async def subscribe_user(member, station_id):
     logger.debug(
         f'Checking if subscription to station with ID {station_id} already exists for user {member.display_name}')
-    user_id = db.record('SELECT UserID FROM subscriptions WHERE UserID = ? AND StationID = ?',
-                        member.id, station_id)
+    user_id = await db.record('SELECT UserID FROM subscriptions WHERE UserID = ? AND StationID = ?',
+                              member.id, station_id)
     if user_id:
         logger.debug('Subscription already exists!')
         return False
 
     logger.debug(f'Subscribing {member.display_name} to station {station_id}')
-    db.execute('INSERT INTO subscriptions (UserID, StationID) VALUES (?, ?)', member.id, station_id)
+    await db.execute('INSERT INTO subscriptions (UserID, StationID) VALUES (?, ?)', member.id, station_id)
     return True
 
 
-def get_stations(user_id):
-    sites = db.records('SELECT stations.StationID, StationName FROM stations '
-                       'INNER JOIN subscriptions ON stations.StationID = subscriptions.StationID '
-                       'WHERE subscriptions.UserID = ?', user_id)
+def parse_period(period):
+    """
+    Converts a report period such as 30d, 6m, 1y or 10y to a number of days, or 'all' to None for the period of
+    record.
+    """
+    if period is None:
+        return 30
+    period = period.lower()
+    if period == 'all':
+        return None
+    match = PERIOD_PATTERN.fullmatch(period)
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f'{period} is not a valid report period. Use a number of days, weeks, months or years '
+                          f'such as 30d, 6m or 10y, or all for the whole period of record.')
+    days = int(match.group(1)) * PERIOD_DAYS[match.group(2)]
+    # Periods reaching back before any recorded values cover the period of record
+    if days >= (datetime.date.today() - RECORD_START).days:
+        return None
+    return days
+
+
+def describe_period(days):
+    if days is None:
+        return 'the whole period of record'
+    if days % 365 == 0:
+        years = days // 365
+        return 'the previous year' if years == 1 else f'the previous {years} years'
+    return f'the previous {days} days'
+
+
+def percentile_msg(stats):
+    return f'{flow_stats.ordinal(round(stats.percentile))} percentile'
+
+
+def stale_msg(series):
+    return f'USGS could not be reached, so this report shows the stored values up to {series.latest_date:%m/%d/%Y}.'
+
+
+def add_percentile_fields(embed, stats):
+    embed.add_field(name=f'Compared to {flow_stats.day_name(stats.day)}', value=percentile_msg(stats))
+    embed.add_field(name='Median', value=f'{format_cfs(stats.median)} CFS')
+    embed.add_field(name=f'Range over {stats.years} years',
+                    value=f'{format_cfs(stats.minimum)} to {format_cfs(stats.maximum)} CFS')
+
+
+def summary_embed(ctx, station_ids, station_names, series_list, stats, footer=()):
+    """
+    Creates the embed listing the latest value of each of a user's stations for a multi-station report.
+    :param footer: lines added to the end of the embed's footer.
+    """
+    latest_values = dict(get_latest_values(series_list))
+    stale = {series.station_id for series in series_list if series.stale}
+    embed = Embed(title=f'Station report for {ctx.author.display_name}\'s station subscriptions')
+    embed.add_field(name="Station ID", value='\n'.join([str(station_id) for station_id in station_ids]))
+    embed.add_field(name="Station Name",
+                    value='\n'.join([name[:40] + '...' if len(name) > 44 else name for name in station_names]))
+    embed.add_field(name="Latest CFS Value",
+                    value='\n'.join([latest_values.get(station_id, 'N/A') + ('*' if station_id in stale else '')
+                                      + (f' ({percentile_msg(stats[station_id])})' if station_id in stats else '')
+                                      for station_id in station_ids]))
+    lines = []
+    if stats:
+        lines.append('Percentiles compare the latest value with the same day in past years')
+    if stale:
+        lines.append('* USGS could not be reached, showing the last stored values')
+    lines.extend(footer)
+    if lines:
+        embed.set_footer(text='\n'.join(lines))
+    return embed
+
+
+class ReportMenu(ListPageSource):
+    """
+    Pages through a multi-station report, starting with the summary of every station followed by one page per
+    station. A station's chart is only rendered and sent when its page is first shown, while the chart for the page
+    after it is rendered in the background so turning to it is quick.
+    Discord can't add files to the menu's message once it has been sent, so each chart is sent to the report's
+    channel below the menu and linked from its page. When a chart_channel is given the charts are uploaded there
+    instead and shown in the page itself.
+    """
+
+    def __init__(self, ctx, summary, series_list, stats, chart_channel=None):
+        self.ctx = ctx
+        self.summary = summary
+        self.stats = stats
+        self.chart_channel = chart_channel
+        # Station ID to the task rendering its chart, which results in the PNG bytes
+        self._renders = {}
+        # Station ID to the task sending its chart, which results in the sent message
+        self._sent = {}
+
+        super().__init__([None, *series_list], per_page=1)
+
+    async def _render_chart(self, series):
+        try:
+            return (await render_line_charts([series], backend=CHART_BACKEND))[0]
+        except Exception:
+            logger.exception(f'Failed to render the chart for station {series.station_id}')
+
+    async def _send_chart(self, series):
+        pic = await self.render(series)
+        if pic is None:
+            return None
+        try:
+            file = discord.File(io.BytesIO(pic), filename=f'{series.station_id}_report.png')
+            if self.chart_channel is not None:
+                messages = await self.ctx.bot.outbox.send(self.chart_channel, self.ctx.author.id, files=[file])
+            else:
+                messages = await self.ctx.bot.outbox.send(self.ctx.channel, self.ctx.author.id,
+                                                          content=f'{series.site_name} ({series.station_id})',
+                                                          files=[file])
+            return messages[0]
+        except Exception:
+            logger.exception(f'Failed to send the chart for station {series.station_id}')
+
+    def render(self, series):
+        if series.station_id not in self._renders:
+            self._renders[series.station_id] = asyncio.ensure_future(self._render_chart(series))
+        return self._renders[series.station_id]
+
+    def send(self, series):
+        if series.station_id not in self._sent:
+            self._sent[series.station_id] = asyncio.ensure_future(self._send_chart(series))
+        return self._sent[series.station_id]
+
+    async def format_page(self, menu, series):
+        if menu.current_page + 1 < len(self.entries):
+            self.render(self.entries[menu.current_page + 1])
+        if series is None:
+            return self.summary
+
+        desc = f'Current flow: {format_cfs(series.latest_value)}'
+        if series.stale:
+            desc += f'\n\n{stale_msg(series)}'
+        message = await self.send(series)
+        if message is None:
+            # Forgotten so the chart is tried again the next time the page is shown
+            self._renders.pop(series.station_id, None)
+            del self._sent[series.station_id]
+            desc += '\n\nThe chart could not be sent, try turning back to this page later.'
+        elif self.chart_channel is None:
+            desc += f'\n\n[Chart]({message.jump_url})'
+        embed = Embed(title=f'Station report for {series.site_name} ({series.station_id})', description=desc,
+                      color=self.ctx.author.color)
+        if series.station_id in self.stats:
+            add_percentile_fields(embed, self.stats[series.station_id])
+        if message is not None and self.chart_channel is not None:
+            embed.set_image(url=message.attachments[0].url)
+        embed.set_footer(text=f'Station {menu.current_page} of {len(self.entries) - 1}')
+        return embed
+
+
+async def get_stations(user_id):
+    sites = await db.records('SELECT stations.StationID, StationName FROM stations '
+                             'INNER JOIN subscriptions ON stations.StationID = subscriptions.StationID '
+                             'WHERE subscriptions.UserID = ?', user_id)
     return sites
 
 
@@ -66,7 +240,7 @@ class Station(Cog):
     @cooldown(3, 30, BucketType.user)
     async def list_stations(self, ctx):
         logger.debug(f'{ctx.author.display_name} has requested a list of stations')
-        sites = get_stations(ctx.author.id)
+        sites = await get_stations(ctx.author.id)
         if len(sites) == 0:
             logger.debug('Did not find any stations in the database.')
             await no_subs_msg(self.bot, ctx)
@@ -85,9 +259,9 @@ class Station(Cog):
     @cooldown(4, 45, BucketType.user)
     async def add_station(self, ctx, station: int):
         logger.debug(f'{ctx.author.display_name} has requested a subscription to the station with ID {station}')
-        station_name = get_station_name(station)
+        station_name = await get_station_name(station)
         if station_name:
-            subscribed = subscribe_user(ctx.author, station)
+            subscribed = await subscribe_user(ctx.author, station)
             if subscribed:
                 await ctx.send(
                     f"Successfully subscribed {ctx.author.display_name} to station {station_name} ({station})!")
@@ -101,50 +275,119 @@ class Station(Cog):
                            f'(https://maps.waterdata.usgs.gov/mapper/index.html) to confirm you have the correct '
                            f'ID')
 
+    @command(name='find_station', aliases=['search_stations'])
+    @cooldown(5, 30, BucketType.user)
+    async def find_station(self, ctx, *, text: str):
+        """Searches stations by name. End the search with a state code (e.g. `green river UT`) to search one state."""
+        logger.debug(f'{ctx.author.display_name} has searched for stations matching {text}')
+        words = text.split()
+        state_cd = None
+        if len(words) > 1 and words[-1].upper() in STATE_CODES:
+            state_cd = words.pop().upper()
+        sites = await find_sites(' '.join(words), state_cd=state_cd)
+        if not sites:
+            await ctx.send(f'No stations found matching "{text}".')
+            return
+
+        embed = Embed(title=f'Stations matching "{text}"', color=ctx.author.color)
+        embed.add_field(name="Station ID", value='\n'.join([str(site[0]) for site in sites]))
+        embed.add_field(name="Station Name",
+                        value='\n'.join([site[1][:40] + '...' if len(site[1]) > 44 else site[1] for site in sites]))
+        embed.add_field(name="State", value='\n'.join([site[2] for site in sites]))
+        embed.set_footer(
+            text=f'Subscribe to a station with {get_prefix(self.bot, ctx.message)[-1]}add_station StationID')
+        await ctx.send(embed=embed)
+
+    @command(name='import_sites')
+    @is_owner()
+    async def import_site_inventory(self, ctx):
+        """Re-imports the USGS site inventory used by find_station and add_station."""
+        await ctx.send('Importing the USGS site inventory, this will take a few minutes.')
+        imported = await import_sites()
+        await ctx.send(f'Imported {imported:,} stations.')
 
     @command(name="station_report", aliases=['report'])
-    async def station_report(self, ctx, station: Optional[int]):
-        logger.debug(f'{ctx.author.display_name} has requested a station report. Provided station: {station}')
+    async def station_report(self, ctx, station: Optional[int], period: Optional[str]):
+        """Reports a station, or all your stations when left out, over the last 30 days or the given period
+        (e.g. 1y, 10y or all)."""
+        logger.debug(f'{ctx.author.display_name} has requested a station report. Provided station: {station}, '
+                     f'period: {period}')
+        try:
+            days = parse_period(period)
+        except ValueError as exc:
+            await ctx.send(str(exc))
+            return
         if station:
             # If we're only reporting one station we can send to channel
-            cfs_data = get_daily_site_data([station])
-            station_name = cfs_data['value']['timeSeries'][0]['sourceInfo']['siteName']
-            last_measurement = cfs_data['value']['timeSeries'][0]['values'][0]['value'][-1]['value']
-            fig = create_line_charts(cfs_data)
-            pic = export_png(fig, filename='temp/station_report.png')
-            desc = f'The first graph is a USGS generated graph requesting data from the previous ' \
-                   f'30 days although they often only graph data from the previous week. The lower graph ' \
-                   f'is bot generated using USGS data from the previous 30 days.\n\nCurrent flow: {last_measurement}'
+            series_list = await get_daily_site_data([station], days=days)
+            if not series_list:
+                await ctx.send(f'Unable to find any streamflow data for station {station}.')
+                return
+            series = series_list[0]
+            station_name = series.site_name
+            last_measurement = format_cfs(series.latest_value)
+            pic = (await render_line_charts(series_list, backend=CHART_BACKEND))[0]
+            desc = f'The first graph is a USGS generated graph requesting data from {describe_period(days)} ' \
+                   f'although they often only graph data from the previous week. The lower graph ' \
+                   f'is bot generated using USGS data from {describe_period(days)}.' \
+                   f'\n\nCurrent flow: {last_measurement}'
+            if series.stale:
+                desc += f'\n\n{stale_msg(series)}'
             embed = Embed(title=f"Station report for {station_name} ({station})", description=desc)
+            stats = (await self.percentiles(series_list)).get(series.station_id)
+            if stats:
+                add_percentile_fields(embed, stats)
             """
             The Discord application will cache the image content so we need to use the data filter with the USGS link 
             to ensure that the url also changes on a daily basis
             """
-            current_date = datetime.datetime.today()
-            month_past = current_date - datetime.timedelta(days=30)
-            embed.set_image(url=f'https://waterdata.usgs.gov/nwisweb/graph?agency_cd=USGS&site_no={station}&parm_cd=00060&startDT={month_past:%Y-%m-%d}')
-            await ctx.send(embed=embed)
-            await ctx.send(file=discord.File(pic))
+            period_start = series.dates[0].astype(object) if days is None else \
+                datetime.datetime.today() - datetime.timedelta(days=days)
+            embed.set_image(url=f'https://waterdata.usgs.gov/nwisweb/graph?agency_cd=USGS&site_no={station}&parm_cd=00060&startDT={period_start:%Y-%m-%d}')
+            await self.bot.outbox.send(ctx.channel, ctx.author.id, embed=embed,
+                                       files=[discord.File(io.BytesIO(pic), filename=f'{station}_report.png')])
         else:
-            stations = get_stations(ctx.author.id)
+            stations = await get_stations(ctx.author.id)
             station_ids = [station[0] for station in stations]
             station_names = [station[1] for station in stations]
             if not station_ids:
                 await no_subs_msg(self.bot, ctx)
-            cfs_data = get_daily_site_data(station_ids)
-            figs = create_line_charts(cfs_data)
-            latest_values = get_latest_values(cfs_data)
-            embed = Embed(title=f'Station report for {ctx.author.display_name}\'s station subscriptions')
-            embed.add_field(name="Station ID", value='\n'.join([str(station_id) for station_id in station_ids]))
-            embed.add_field(name="Station Name",
-                            value='\n'.join([name[:40] + '...' if len(name) > 44 else name for name in station_names]))
-            embed.add_field(name="Latest CFS Value", value='\n'.join([data[1] for data in latest_values]))
-            await ctx.send(embed=embed)
-            for station_idx, fig in enumerate(figs):
-                pic = export_png(fig, filename=f'temp/{station_ids[station_idx]}_report.png')
-                await ctx.send(file=discord.File(pic))
+                return
+            series_list = await get_daily_site_data(station_ids, days=days)
+            stats = await self.percentiles(series_list)
+            if MULTI_REPORT_MODE == 'menu':
+                # Only the summary is sent straight away, charts wait until their station's page is shown
+                embed = summary_embed(ctx, station_ids, station_names, series_list, stats,
+                                      footer=['Use the reactions below to see the chart of each station'])
+                chart_channel = self.bot.get_channel(REPORT_CHART_CHANNEL) if REPORT_CHART_CHANNEL else None
+                menu = MenuPages(source=ReportMenu(ctx, embed, series_list, stats, chart_channel),
+                                 clear_reactions_after=True, timeout=REPORT_MENU_TIMEOUT)
+                await menu.start(ctx)
+                return
+            if MULTI_REPORT_MODE == 'separate':
+                pics = await render_line_charts(series_list, backend=CHART_BACKEND)
+                filenames = [f'{series.station_id}_report.png' for series in series_list]
+            else:
+                pics = await render_report_pages(series_list, per_page=REPORT_PANELS_PER_PAGE,
+                                                 columns=REPORT_PANEL_COLUMNS, backend=CHART_BACKEND)
+                filenames = [f'report_page_{page + 1}.png' for page in range(len(pics))]
+            embed = summary_embed(ctx, station_ids, station_names, series_list, stats)
+            await self.bot.outbox.send(ctx.channel, ctx.author.id, embed=embed,
+                                       files=[discord.File(io.BytesIO(pic), filename=filename)
+                                              for filename, pic in zip(filenames, pics)])
             desc = f'Line graph of streamflow data for all stations subcribed to by {ctx.author.display_name}'
 
+    async def percentiles(self, series_list):
+        """
+        Looks up the day of year percentiles of the given StationSeries. Stations without any are computed in the
+        background, so a later report can include them.
+        """
+        stats = await flow_stats.lookup(series_list)
+        missing = [series.station_id for series in series_list if series.station_id not in stats]
+        if missing:
+            self.bot.scheduler.add_job(flow_stats.refresh, args=[missing])
+        return stats
+
     @Cog.listener()
     async def on_ready(self):
         if not self.bot.ready:
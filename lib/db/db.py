@@ -1,74 +1,276 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os.path import isfile
 from sqlite3 import connect
 
-from apscheduler.triggers.cron import CronTrigger
+from ..utils import metrics
 
-DB_PATH = "./data/db/database.db"
+# STREAMFLOW_DB_PATH points the bot (or a benchmark) at another database. It has to be set before lib.db is imported,
+# which builds the database straight away.
+DB_PATH = os.environ.get('STREAMFLOW_DB_PATH', "./data/db/database.db")
 BUILD_PATH = "./data/db/build.sql"
 
-cxn = connect(DB_PATH, check_same_thread=False)
-cur = cxn.cursor()
+# Reads run on a small pool of threads, each with its own connection. Every write goes through the single writer
+# thread so SQLite never sees two writers at once.
+READ_WORKERS = 4
+# Number of prepared statements kept by each connection
+CACHED_STATEMENTS = 256
+# Writes are journaled and committed together once the oldest has waited FLUSH_INTERVAL seconds or FLUSH_SIZE
+# writes are waiting, whichever comes first
+FLUSH_INTERVAL = 0.05
+FLUSH_SIZE = 100
+
+# Columns added to tables after they were first created as (table, column, definition). build.sql only creates
+# missing tables, so these are added to existing databases when missing.
+MIGRATIONS = [
+    ('guilds', 'ChannelID', 'integer'),
+    ('flow_percentiles_status', 'ProvisionalFrom', 'text'),
+    ('flow_percentiles_status', 'ProvisionalDigest', 'text'),
+]
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_readers = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix='db-read')
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+# Writes waiting for the next group commit as (function, arguments, future) tuples
+_journal = []
+_flush_handle = None
+
+
+def _connection():
+    """
+    Returns the calling thread's connection, opening it on first use or when DB_PATH has been pointed at another
+    database.
+    """
+    cxn = getattr(_local, 'cxn', None)
+    if cxn is not None and _local.path != DB_PATH:
+        cxn.close()
+        cxn = None
+    if cxn is None:
+        cxn = _local.cxn = connect(DB_PATH, cached_statements=CACHED_STATEMENTS)
+        _local.path = DB_PATH
+        # WAL lets the reader threads keep reading while the writer thread commits. Writes are grouped into few
+        # commits so each one can afford a full sync to disk.
+        cxn.execute('PRAGMA journal_mode=WAL')
+        cxn.execute('PRAGMA synchronous=FULL')
+    return cxn
+
+
+def _close_connection():
+    cxn = getattr(_local, 'cxn', None)
+    if cxn is not None:
+        cxn.close()
+        _local.cxn = None
+
+
+async def _read(func, *args):
+    with metrics.span('db_read'):
+        return await asyncio.get_event_loop().run_in_executor(_readers, func, *args)
+
+
+def configure(flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE):
+    global FLUSH_INTERVAL, FLUSH_SIZE
+    FLUSH_INTERVAL = flush_interval
+    FLUSH_SIZE = flush_size
+
+
+def _apply(batch):
+    """
+    Runs a batch of journaled writes on the writer thread and commits them together.
+    :return: list holding the result or raised exception of each write
+    """
+    started = time.perf_counter()
+    cxn = _connection()
+    results = []
+    for func, args in batch:
+        if func is _scriptexec:
+            # executescript commits whatever is pending before it runs, so a script can't sit inside a savepoint
+            try:
+                results.append(func(*args))
+            except Exception as e:
+                results.append(e)
+            continue
+        # Each write runs in its own savepoint so one that fails partway, such as an executemany stopped by a
+        # constraint, leaves nothing behind while the rest of the group is still committed
+        if not cxn.in_transaction:
+            cxn.execute('BEGIN')
+        cxn.execute('SAVEPOINT journaled_write')
+        try:
+            results.append(func(*args))
+        except Exception as e:
+            cxn.execute('ROLLBACK TO journaled_write')
+            results.append(e)
+        cxn.execute('RELEASE journaled_write')
+    try:
+        cxn.commit()
+    except Exception as e:
+        cxn.rollback()
+        results = [e] * len(batch)
+    metrics.observe('db_commit', time.perf_counter() - started)
+    metrics.increment('db_writes', len(batch))
+    return results
+
+
+def _resolve(futures, applied):
+    try:
+        results = applied.result()
+    except Exception as e:
+        results = [e] * len(futures)
+    for future, result in zip(futures, results):
+        if future.done():
+            continue
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+def _flush():
+    """
+    Sends every journaled write to the writer thread as one group commit.
+    :return: future resolved once the group has been committed
+    """
+    global _journal, _flush_handle
+    batch, _journal = _journal, []
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+
+    applied = asyncio.get_event_loop().run_in_executor(_writer, _apply, [(func, args) for func, args, _ in batch])
+    applied.add_done_callback(lambda done: _resolve([future for _, _, future in batch], done))
+    return applied
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Database write failed', exc_info=future.exception())
+
+
+async def _write(func, *args, wait=True):
+    """
+    Journals a write for the next group commit.
+    :param wait: when True, waits until the write has been committed to disk and returns its result.
+    """
+    global _flush_handle
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    _journal.append((func, args, future))
+    if len(_journal) >= FLUSH_SIZE:
+        _flush()
+    elif _flush_handle is None:
+        _flush_handle = loop.call_later(FLUSH_INTERVAL, _flush)
+
+    if not wait:
+        future.add_done_callback(_log_failure)
+        return
+    with metrics.span('db_write'):
+        return await asyncio.shield(future)
 
 
 def with_commit(func):
     def inner(*args, **kwargs):
         func(*args, **kwargs)
-        commit()
+        _connection().commit()
 
     return inner
 
 
+def _migrate():
+    cxn = _connection()
+    for table, column, definition in MIGRATIONS:
+        if column not in [row[1] for row in cxn.execute(f'PRAGMA table_info({table})')]:
+            cxn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
 @with_commit
-def build():
+def _build():
     if isfile(BUILD_PATH):
-        scriptexec(BUILD_PATH)
+        _scriptexec(BUILD_PATH)
+        _migrate()
 
 
-def commit():
-    cxn.commit()
+def build():
+    _writer.submit(_build).result()
 
 
-def autosave(sched):
-    sched.add_job(commit, CronTrigger(second=0))
+async def commit():
+    """
+    Commits every journaled write now instead of waiting for the flush interval.
+    """
+    if _journal:
+        await _flush()
 
 
 def close():
-    cxn.close()
+    # Anything still journaled is committed before the connection closes
+    batch = [(func, args) for func, args, _ in _journal]
+    _journal.clear()
+    if batch:
+        _writer.submit(_apply, batch).result()
+    _writer.submit(_close_connection).result()
+    _writer.shutdown()
+    _readers.shutdown()
+
+
+def _field(command, values):
+    if (fetch := _connection().execute(command, values).fetchone()) is not None:
+        return fetch[0]
 
 
-def field(command, *values):
-    cur.execute(command, tuple(values))
+def _record(command, values):
+    return _connection().execute(command, values).fetchone()
 
-    if (fetch := cur.fetchone()) is not None:
-        return fetch[0]
 
+def _records(command, values):
+    return _connection().execute(command, values).fetchall()
 
-def record(command, *values):
-    cur.execute(command, tuple(values))
 
-    return cur.fetchone()
+def _column(command, values):
+    return [item[0] for item in _connection().execute(command, values).fetchall()]
 
 
-def records(command, *values):
-    cur.execute(command, tuple(values))
+def _execute(command, values):
+    _connection().execute(command, values)
 
-    return cur.fetchall()
 
+def _multiexec(command, valueset):
+    _connection().executemany(command, valueset)
 
-def column(command, *values):
-    cur.execute(command, tuple(values))
 
-    return [item[0] for item in cur.fetchall()]
+def _scriptexec(path):
+    with open(path, 'r', encoding='utf-8') as script:
+        _connection().executescript(script.read())
 
 
-def execute(command, *values):
-    cur.execute(command, tuple(values))
+async def field(command, *values):
+    return await _read(_field, command, tuple(values))
 
 
-def multiexec(command, valueset):
-    cur.executemany(command, valueset)
+async def record(command, *values):
+    return await _read(_record, command, tuple(values))
 
 
-def scriptexec(path):
-    with open(path, 'r', encoding='utf-8') as script:
-        cur.executescript(script.read())
+async def records(command, *values):
+    return await _read(_records, command, tuple(values))
+
+
+async def column(command, *values):
+    return await _read(_column, command, tuple(values))
+
+
+async def execute(command, *values, wait=True):
+    await _write(_execute, command, tuple(values), wait=wait)
+
+
+async def multiexec(command, valueset, wait=True):
+    # Materialise generators here so they aren't consumed on the writer thread
+    await _write(_multiexec, command, list(valueset), wait=wait)
+
+
+async def scriptexec(path, wait=True):
+    await _write(_scriptexec, path, wait=wait)
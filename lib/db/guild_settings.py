@@ -0,0 +1,49 @@
+from . import db
+
+DEFAULT_PREFIX = '!'
+
+# Settings rows from the guilds table keyed by GuildID, each a dict of column name to value
+_settings = {}
+_columns = []
+
+
+async def load():
+    """
+    Loads the settings of every guild into memory. Called once the guilds table has been brought up to date.
+    """
+    global _columns
+    _columns = await db.column("SELECT name FROM pragma_table_info('guilds')")
+    _settings.clear()
+    for row in await db.records(f'SELECT {", ".join(_columns)} FROM guilds'):
+        _settings[row[0]] = dict(zip(_columns, row))
+
+
+def get(guild_id, setting, default=None):
+    value = _settings.get(guild_id, {}).get(setting)
+    return default if value is None else value
+
+
+def prefix(guild_id):
+    return get(guild_id, 'Prefix', DEFAULT_PREFIX)
+
+
+async def add_guild(guild_id):
+    await db.execute('INSERT OR IGNORE INTO guilds (GuildID) VALUES (?)', guild_id)
+    if not _columns:
+        await load()
+        return
+    row = await db.record(f'SELECT {", ".join(_columns)} FROM guilds WHERE GuildID = ?', guild_id)
+    _settings[guild_id] = dict(zip(_columns, row))
+
+
+async def update(guild_id, **settings):
+    """
+    Writes the given settings (column name=value) for a guild to the database and then to the in-memory cache.
+    """
+    unknown = set(settings) - set(_columns)
+    if unknown:
+        raise KeyError(f'Unknown guild settings: {", ".join(sorted(unknown))}')
+
+    assignments = ', '.join(f'{column} = ?' for column in settings)
+    await db.execute(f'UPDATE guilds SET {assignments} WHERE GuildID = ?', *settings.values(), guild_id)
+    _settings.setdefault(guild_id, {'GuildID': guild_id}).update(settings)
@@ -0,0 +1,78 @@
+from collections import namedtuple
+
+import numpy as np
+
+from .get_cfs_data import get_daily_site_data
+from ..db import db
+
+DIRECTIONS = ('above', 'below')
+# Days of values requested when polling, enough to find a latest value through short reporting gaps
+LOOKBACK_DAYS = 7
+
+FiredAlert = namedtuple('FiredAlert', ['alert_id', 'user_id', 'station_id', 'station_name', 'direction',
+                                       'threshold', 'value'])
+
+
+def evaluate(alert_stations, above, thresholds, triggered, station_ids, latest_values):
+    """
+    Evaluates every alert against its station's latest value in one vectorized pass.
+    :param alert_stations: station ID of each alert.
+    :param above: True for alerts on flows above their threshold, False for flows below it.
+    :param thresholds: CFS threshold of each alert.
+    :param triggered: whether each alert was already in its alerting state at the last poll.
+    :param station_ids: sorted array of the station IDs that have a latest value.
+    :param latest_values: latest CFS value of each station in station_ids.
+    :return: tuple of boolean arrays (state, fired). state is whether each alert's condition currently holds,
+    fired marks the alerts that have just crossed their threshold. Alerts whose station has no value keep their state.
+    """
+    alert_stations = np.asarray(alert_stations, dtype=np.int64)
+    above = np.asarray(above, dtype=bool)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    triggered = np.asarray(triggered, dtype=bool)
+    station_ids = np.asarray(station_ids, dtype=np.int64)
+    latest_values = np.asarray(latest_values, dtype=np.float64)
+    if not len(station_ids):
+        return triggered.copy(), np.zeros_like(triggered)
+
+    # Map each alert to its station's latest value with a binary search over the sorted station IDs
+    index = np.minimum(np.searchsorted(station_ids, alert_stations), len(station_ids) - 1)
+    values = latest_values[index]
+    known = (station_ids[index] == alert_stations) & ~np.isnan(values)
+
+    exceeded = np.where(above, values > thresholds, values < thresholds)
+    state = np.where(known, exceeded, triggered)
+    return state, state & ~triggered
+
+
+async def poll():
+    """
+    Fetches the latest values of every station with an alert and evaluates all alerts against them. Alerts are edge
+    triggered, so an alert only fires again after its flow has gone back across the threshold.
+    :return: list of FiredAlert for the alerts that have just crossed their threshold
+    """
+    rows = await db.records('SELECT AlertID, UserID, StationID, Direction, Threshold, Triggered FROM alerts '
+                            'ORDER BY StationID, Direction, Threshold')
+    if not rows:
+        return []
+
+    alert_ids, user_ids, alert_stations, directions, thresholds, triggered = (np.array(column)
+                                                                               for column in zip(*rows))
+    series_list = await get_daily_site_data(sorted(set(alert_stations.tolist())), days=LOOKBACK_DAYS)
+    latest = sorted((series.station_id, series.latest_value) for series in series_list if len(series))
+    station_ids, latest_values = zip(*latest) if latest else ((), ())
+
+    triggered = triggered.astype(bool)
+    state, fired = evaluate(alert_stations, directions == 'above', thresholds, triggered, station_ids,
+                            latest_values)
+
+    changed = np.flatnonzero(state != triggered)
+    if len(changed):
+        await db.multiexec('UPDATE alerts SET Triggered = ? WHERE AlertID = ?',
+                           ((int(state[i]), int(alert_ids[i])) for i in changed))
+
+    names = {series.station_id: series.site_name for series in series_list}
+    values = dict(latest)
+    return [FiredAlert(int(alert_ids[i]), int(user_ids[i]), int(alert_stations[i]),
+                       names.get(int(alert_stations[i])), str(directions[i]), float(thresholds[i]),
+                       values[int(alert_stations[i])])
+            for i in np.flatnonzero(fired)]
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from . import metrics
+
+CACHE_DIR = './temp/charts'
+
+
+def chart_key(station_id, dates, values, *options):
+    """
+    Returns a content address for a chart built from the given station, date range and values. Any option that
+    changes the rendered image (backend, size, title...) should be passed in options.
+    :param dates: datetime64 array of the chart's dates.
+    :param values: float64 array of the chart's values.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((str(station_id), str(dates[0]) if len(dates) else None,
+                        str(dates[-1]) if len(dates) else None, options)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(dates).tobytes())
+    digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class ChartCache(object):
+    """
+    Size bounded LRU cache of rendered PNG charts held in memory and backed by a directory on disk.
+    """
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        # Renders in progress by key, shared by every caller asking for the same chart at the same time
+        self._pending = {}
+
+        if self.directory and self.max_disk_bytes:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.png'):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.png')
+
+    def _remember(self, key, png):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = png
+        self._memory_bytes += len(png)
+        while self._memory_bytes > self.max_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        with open(path, 'rb') as png_file:
+            png = png_file.read()
+        os.utime(path)
+        return png
+
+    def _write_disk(self, key, png):
+        path = self._path(key)
+        # Write to a temporary name first so a concurrent reader never sees a partial file
+        with open(f'{path}.tmp', 'wb') as png_file:
+            png_file.write(png)
+        os.replace(f'{path}.tmp', path)
+
+    async def get(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            try:
+                png = await asyncio.get_event_loop().run_in_executor(None, self._read_disk, key)
+            except FileNotFoundError:
+                self._disk_bytes -= self._disk.pop(key)
+            else:
+                self._remember(key, png)
+                self.hits += 1
+                return png
+
+        self.misses += 1
+
+    async def put(self, key, png):
+        self._remember(key, png)
+        if self.directory and self.max_disk_bytes and key not in self._disk:
+            await asyncio.get_event_loop().run_in_executor(None, self._write_disk, key, png)
+            self._disk[key] = len(png)
+            self._disk_bytes += len(png)
+            self._evict_disk()
+
+    async def _render_and_store(self, key, render):
+        png = await render()
+        await self.put(key, png)
+        return png
+
+    async def get_or_render(self, key, render):
+        """
+        Returns the cached chart for key, awaiting render() to create and store it on a miss. Concurrent misses for
+        the same key share a single render.
+        """
+        if key in self._pending:
+            self.hits += 1
+            return await asyncio.shield(self._pending[key])
+
+        png = await self.get(key)
+        if png is not None:
+            return png
+
+        if key not in self._pending:
+            task = asyncio.ensure_future(self._render_and_store(key, render))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(self._pending[key])
+
+
+cache = ChartCache(32 * 1024 * 1024)
+
+
+metrics.gauge('chart_cache_hits', lambda: cache.hits, 'Charts served from the chart cache')
+metrics.gauge('chart_cache_misses', lambda: cache.misses, 'Charts that had to be rendered')
+metrics.gauge('chart_cache_bytes', lambda: cache._memory_bytes, 'Size of the charts held in memory')
+
+
+def configure(max_mb=32, disk_max_mb=256, directory=CACHE_DIR):
+    global cache
+    cache = ChartCache(max_mb * 1024 * 1024, directory=directory, max_disk_bytes=disk_max_mb * 1024 * 1024)
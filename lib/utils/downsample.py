@@ -0,0 +1,84 @@
+import numpy as np
+
+from .series import StationSeries
+
+METHODS = ('minmax', 'lttb')
+
+
+def minmax(x, y, buckets):
+    """
+    Keeps the lowest and highest point of each of `buckets` equally wide ranges of x, plus the first and last point.
+    Drawn one bucket per pixel column this looks the same as the full series, every peak and trough included.
+    :param x: sorted int64 or datetime64 array.
+    :param y: float array matching x.
+    :return: indices of the kept points in ascending order
+    """
+    n = len(y)
+    if n <= 2 * buckets:
+        return np.arange(n)
+    positions = x.astype(np.int64)
+    edges = np.searchsorted(positions, np.linspace(positions[0], positions[-1] + 1, buckets + 1))
+    starts, ends = edges[:-1], edges[1:]
+    filled = starts < ends
+    starts, ends = starts[filled], ends[filled]
+
+    # Sorting by bucket then value puts each bucket's minimum first and maximum last within the bucket's slice
+    bucket_ids = np.repeat(np.arange(len(starts)), ends - starts)
+    order = np.lexsort((y, bucket_ids))
+    return np.unique(np.concatenate(([0, n - 1], order[starts], order[ends - 1])))
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: keeps `threshold` points chosen to preserve the visual shape of the series. Each
+    bucket keeps the point forming the largest triangle with the point kept from the bucket before it and the
+    average of the bucket after it. The areas within each bucket are computed together, only the walk from bucket
+    to bucket is sequential.
+    :param x: sorted int64 or datetime64 array.
+    :param y: float array matching x.
+    :return: indices of the kept points in ascending order
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    xs = x.astype(np.int64).astype(np.float64)
+    ys = np.asarray(y, dtype=np.float64)
+
+    # The first and last points are always kept, the rest are split into threshold - 2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    counts = np.diff(edges)
+    averages_x = np.add.reduceat(xs[:-1], edges[:-1]) / counts
+    averages_y = np.add.reduceat(ys[:-1], edges[:-1]) / counts
+    # The third vertex for each bucket is the average of the bucket after it, or the last point for the last bucket
+    next_x = np.append(averages_x[1:], xs[-1])
+    next_y = np.append(averages_y[1:], ys[-1])
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    anchor = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        areas = np.abs((xs[anchor] - next_x[i]) * (ys[start:end] - ys[anchor])
+                       - (xs[anchor] - xs[start:end]) * (next_y[i] - ys[anchor]))
+        anchor = start + int(np.argmax(areas))
+        kept[i + 1] = anchor
+    return kept
+
+
+def downsample(series, points, method='minmax'):
+    """
+    Returns the given StationSeries reduced to about `points` points for drawing, or the series itself when it is
+    already small enough.
+    :param points: number of points to keep with 'lttb', or number of buckets (usually the chart's width in pixels)
+    with 'minmax', which keeps up to two points per bucket.
+    """
+    if method not in METHODS:
+        raise ValueError(f'Unknown downsampling method {method!r}, expected one of {METHODS}')
+    if len(series) <= points:
+        return series
+    if method == 'lttb':
+        kept = lttb(series.dates, series.values, points)
+    else:
+        kept = minmax(series.dates, series.values, points)
+    return StationSeries(series.station_id, series.site_name, series.dates[kept], series.values[kept],
+                         series.qualifiers[kept], stale=series.stale)
@@ -0,0 +1,173 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+
+from . import metrics
+
+# Longest a single attempt, hedged duplicate included, may take before it's abandoned
+ATTEMPT_TIMEOUT = 8.0
+# Longest a single attempt at a station's history may take, these responses can hold a century of daily values
+HISTORY_TIMEOUT = 120.0
+# Attempts made after the first one fails
+RETRIES = 2
+# Retry delays grow exponentially from BACKOFF_BASE seconds up to BACKOFF_MAX, with full jitter
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 4.0
+# Seconds after which a duplicate of a still unanswered request is sent, None to never hedge
+HEDGE_DELAY = None
+# Consecutive failures that open an endpoint's circuit, and seconds before a trial request is let through again
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 60.0
+# Statuses worth retrying, along with every 5xx status
+RETRY_STATUSES = (408, 429)
+
+
+class UpstreamError(Exception):
+    """
+    Raised by an attempt when the server answered with a status worth retrying.
+    """
+
+
+class CircuitOpen(UpstreamError):
+    """
+    Raised without making a request while an endpoint's circuit is open.
+    """
+
+
+RETRYABLE = (aiohttp.ClientError, asyncio.TimeoutError, UpstreamError)
+
+
+def should_retry(status):
+    return status >= 500 or status in RETRY_STATUSES
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to an endpoint that keeps failing. After FAILURE_THRESHOLD consecutive failures the circuit
+    opens and requests are refused until RESET_TIMEOUT has passed, then a single trial request decides whether it
+    closes again.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        """
+        True while requests would be refused, without using up the trial request.
+        """
+        if self.opened_at is None:
+            return False
+        return self._trial or time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.is_open:
+            return False
+        self._trial = True
+        return True
+
+    def end_trial(self):
+        self._trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._trial:
+                metrics.increment('circuit_opened')
+            self.opened_at = time.monotonic()
+            self._trial = False
+
+
+_breakers = {}
+
+
+def configure(timeout=ATTEMPT_TIMEOUT, retries=RETRIES, hedge_delay=HEDGE_DELAY, failure_threshold=FAILURE_THRESHOLD,
+              reset_timeout=RESET_TIMEOUT, history_timeout=HISTORY_TIMEOUT):
+    global ATTEMPT_TIMEOUT, RETRIES, HEDGE_DELAY, FAILURE_THRESHOLD, RESET_TIMEOUT, HISTORY_TIMEOUT
+    ATTEMPT_TIMEOUT = timeout
+    HISTORY_TIMEOUT = history_timeout
+    RETRIES = retries
+    HEDGE_DELAY = hedge_delay
+    FAILURE_THRESHOLD = failure_threshold
+    RESET_TIMEOUT = reset_timeout
+    _breakers.clear()
+
+
+def breaker(endpoint):
+    if endpoint not in _breakers:
+        _breakers[endpoint] = CircuitBreaker(FAILURE_THRESHOLD, RESET_TIMEOUT)
+    return _breakers[endpoint]
+
+
+def backoff(retry):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retry))
+
+
+async def _hedged(attempt, delay):
+    """
+    Runs attempt() and, if it hasn't finished after delay seconds, a duplicate of it. The first to succeed wins and
+    the other is cancelled.
+    """
+    tasks = {asyncio.ensure_future(attempt())}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            metrics.increment('hedged_requests')
+            tasks.add(asyncio.ensure_future(attempt()))
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call(endpoint, attempt, timeout=None):
+    """
+    Calls attempt(), a coroutine function making a single request, with a bounded timeout, jittered retries,
+    optional hedging and the endpoint's circuit breaker.
+    :param endpoint: name of the upstream endpoint, each has its own circuit breaker.
+    :param timeout: seconds each attempt may take, defaults to ATTEMPT_TIMEOUT.
+    :return: the result of the first attempt that succeeds
+    :raises CircuitOpen: when the endpoint's circuit is open and no request was made.
+    """
+    circuit = breaker(endpoint)
+    if not circuit.allow():
+        metrics.increment('circuit_rejected')
+        raise CircuitOpen(f'The {endpoint} circuit is open')
+
+    for retry in range(RETRIES + 1):
+        try:
+            result = await asyncio.wait_for(_hedged(attempt, HEDGE_DELAY) if HEDGE_DELAY else attempt(),
+                                            timeout or ATTEMPT_TIMEOUT)
+        except RETRYABLE:
+            circuit.record_failure()
+            if retry == RETRIES or circuit.is_open:
+                raise
+            metrics.increment('retries')
+            await asyncio.sleep(backoff(retry))
+        except BaseException:
+            # Anything else, cancellation included, says nothing about the endpoint but still ends a trial request
+            circuit.end_trial()
+            raise
+        else:
+            circuit.record_success()
+            return result
@@ -0,0 +1,214 @@
+import datetime
+import hashlib
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from .get_cfs_data import REVISION_DAYS, get_daily_site_data
+from ..db import db
+
+# Percentiles stored for each calendar day, every fifth from the minimum (0) to the maximum (100)
+QUANTILES = np.linspace(0, 100, 21)
+# Calendar days with fewer years of values than this don't get percentiles, they wouldn't mean much
+MIN_YEARS = 10
+# New stations whose period of record is requested together on each step of a refresh
+HISTORY_CHUNK_SIZE = 10
+# First day of each month counted in a leap year, so February 29 keeps its own day and March 1 is always day 60
+MONTH_STARTS = np.array([0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335])
+
+# Stations whose percentiles are being refreshed, so overlapping refreshes don't compute the same station twice
+_refreshing = set()
+
+FlowStats = namedtuple('FlowStats', ['day', 'percentile', 'median', 'minimum', 'maximum', 'years'])
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to debug
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+
+# create formatter
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# add formatter to ch
+ch.setFormatter(formatter)
+
+# add ch to logger
+logger.addHandler(ch)
+
+
+def day_of_year(dates):
+    """
+    Returns the calendar day (0 to 365) of each of the given dates, counted as if every year was a leap year so the
+    same date always falls on the same day.
+    :param dates: datetime64[D] array.
+    """
+    months = dates.astype('datetime64[M]')
+    return MONTH_STARTS[months.astype(np.int64) % 12] + (dates - months).astype(np.int64)
+
+
+def quantile_table(days, values, quantiles=QUANTILES):
+    """
+    Computes the given percentiles of the values falling on each calendar day in one vectorized pass, interpolating
+    linearly between the closest values like numpy.percentile.
+    :param days: calendar day of each value as returned by day_of_year.
+    :param values: float array of daily values matching days.
+    :return: tuple (days, counts, table) with the sorted distinct days, the number of values on each and a
+    len(days) by len(quantiles) array of percentiles
+    """
+    # Sorting by day then value lays each day's values out in order within its own slice
+    order = np.lexsort((values, days))
+    days, values = days[order], values[order]
+    distinct, starts, counts = np.unique(days, return_index=True, return_counts=True)
+    positions = starts[:, None] + (counts[:, None] - 1) * (np.asarray(quantiles) / 100)[None, :]
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, (starts + counts - 1)[:, None])
+    fraction = positions - lower
+    return distinct, counts, values[lower] * (1 - fraction) + values[upper] * fraction
+
+
+def percentile_of(value, quantiles):
+    """
+    Returns where value falls among a calendar day's stored percentiles, from 0 at the minimum to 100 at the maximum.
+    When several percentiles share the value, as with long runs of zero flow, the middle of them is used.
+    """
+    first, last = np.searchsorted(quantiles, value, side='left'), np.searchsorted(quantiles, value, side='right')
+    if first < last:
+        return float((QUANTILES[first] + QUANTILES[last - 1]) / 2)
+    return float(np.interp(value, quantiles, QUANTILES))
+
+
+def ordinal(number):
+    suffix = 'th' if 10 <= number % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(number % 10, 'th')
+    return f'{number}{suffix}'
+
+
+async def _digest(station_id, start_date, end_date):
+    """
+    Returns a fingerprint of a station's stored values from start_date through end_date, which changes whenever any
+    of them does.
+    """
+    rows = await db.records('SELECT ObsDate, Value, Qualifiers FROM observations WHERE StationID = ? '
+                            'AND ObsDate BETWEEN ? AND ? ORDER BY ObsDate', station_id, start_date, end_date)
+    return hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+
+
+async def _refresh_station(station_id, status):
+    """
+    Recomputes a station's stored percentiles from its observations. Only the calendar days that received values
+    since the last computation are recomputed, along with the days from the first provisional value on if USGS has
+    revised any of them since, unless older history has been stored since, which changes them all.
+    :param status: (through date, first date, first provisional date, digest of the values from it through the through
+    date) of the last computation, or None if there hasn't been one.
+    """
+    first_date, last_date = await db.record('SELECT MIN(ObsDate), MAX(ObsDate) FROM observations '
+                                            'WHERE StationID = ?', station_id)
+    if last_date is None:
+        return
+    # Older provisional values are never asked for again so they can't change
+    revision_start = (datetime.date.today() - datetime.timedelta(days=REVISION_DAYS)).isoformat()
+    provisional_from = await db.field('SELECT MIN(ObsDate) FROM observations WHERE StationID = ? AND ObsDate >= ? '
+                                      "AND ',' || Qualifiers || ',' LIKE '%,P,%'", station_id, revision_start)
+    # Taken before the values are read, so a revision stored in the meantime shows up as a change next time
+    digest = await _digest(station_id, provisional_from, last_date) if provisional_from else None
+    if status is not None and status[1] == first_date:
+        through_date, _, revised_from, revised_digest = status
+        revised = (revised_from is not None
+                   and await _digest(station_id, revised_from, through_date) != revised_digest)
+        if through_date >= last_date and not revised:
+            return
+        since = min(through_date, revised_from) if revised else through_date
+        month_days = await db.column('SELECT DISTINCT substr(ObsDate, 6) FROM observations '
+                                     'WHERE StationID = ? AND ObsDate >= ?', station_id, since)
+        rows = await db.records('SELECT ObsDate, Value FROM observations WHERE StationID = ? '
+                                f'AND substr(ObsDate, 6) IN ({",".join("?" * len(month_days))})',
+                                station_id, *month_days)
+    else:
+        rows = await db.records('SELECT ObsDate, Value FROM observations WHERE StationID = ?', station_id)
+        await db.execute('DELETE FROM flow_percentiles WHERE StationID = ?', station_id, wait=False)
+
+    dates, values = zip(*rows)
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    values = np.asarray(values, dtype=np.float64)
+    known = ~np.isnan(values)
+    days, counts, table = quantile_table(day_of_year(dates[known]), values[known])
+    enough = counts >= MIN_YEARS
+    await db.multiexec('INSERT OR REPLACE INTO flow_percentiles (StationID, DayOfYear, Years, Quantiles) '
+                       'VALUES (?, ?, ?, ?)',
+                       ((station_id, int(day), int(count), quantiles.tobytes())
+                        for day, count, quantiles in zip(days[enough], counts[enough], table[enough])), wait=False)
+    await db.execute('INSERT OR REPLACE INTO flow_percentiles_status (StationID, ThroughDate, FirstDate, '
+                     'ProvisionalFrom, ProvisionalDigest) VALUES (?, ?, ?, ?, ?)',
+                     station_id, last_date, first_date, provisional_from, digest, wait=False)
+    logger.debug(f'Computed percentiles for {int(enough.sum())} days of station {station_id}')
+
+
+async def refresh(station_ids):
+    """
+    Brings the day of year percentiles of the given stations up to date with their stored values. The period of
+    record is requested from USGS the first time a station is computed, a few stations at a time, after that only
+    the calendar days that received new or revised values are recomputed. Stations whose history couldn't be fetched
+    are skipped until a later refresh succeeds, and stations already being refreshed are left to that refresh.
+    """
+    station_ids = [station_id for station_id in dict.fromkeys(int(station_id) for station_id in station_ids)
+                   if station_id not in _refreshing]
+    if not station_ids:
+        return
+    _refreshing.update(station_ids)
+    try:
+        await _refresh(station_ids)
+    finally:
+        _refreshing.difference_update(station_ids)
+
+
+async def _refresh(station_ids):
+    status = {station_id: tuple(row) for station_id, *row in await db.records(
+        'SELECT StationID, ThroughDate, FirstDate, ProvisionalFrom, ProvisionalDigest FROM flow_percentiles_status '
+        f'WHERE StationID IN ({",".join("?" * len(station_ids))})', *station_ids)}
+    new = [station_id for station_id in station_ids if station_id not in status]
+    missing_history = set()
+    for i in range(0, len(new), HISTORY_CHUNK_SIZE):
+        chunk = new[i:i + HISTORY_CHUNK_SIZE]
+        complete = {series.station_id for series in await get_daily_site_data(chunk, days=None) if not series.stale}
+        # Left without a status so the next refresh asks for their history again
+        missing_history.update(station_id for station_id in chunk if station_id not in complete)
+    if missing_history:
+        logger.warning(f'Could not fetch the history of stations {sorted(missing_history)}')
+
+    for station_id in station_ids:
+        if station_id in missing_history:
+            continue
+        try:
+            await _refresh_station(station_id, status.get(station_id))
+        except Exception:
+            logger.exception(f'Failed to compute percentiles for station {station_id}')
+
+
+async def lookup(series_list):
+    """
+    Compares the latest value of each of the given StationSeries with the stored percentiles for its calendar day.
+    :return: dict of station ID to FlowStats, leaving out stations without percentiles for that day
+    """
+    latest = {series.station_id: (int(day_of_year(series.dates[-1:])[0]), series.latest_value)
+              for series in series_list if len(series) and not np.isnan(series.values[-1])}
+    if not latest:
+        return {}
+    rows = await db.records('SELECT StationID, DayOfYear, Years, Quantiles FROM flow_percentiles WHERE '
+                            + ' OR '.join(['(StationID = ? AND DayOfYear = ?)'] * len(latest)),
+                            *(value for station_id, (day, _) in latest.items() for value in (station_id, day)))
+    stats = {}
+    for station_id, day, years, blob in rows:
+        quantiles = np.frombuffer(blob, dtype=np.float64)
+        value = latest[station_id][1]
+        stats[station_id] = FlowStats(day, percentile_of(value, quantiles), float(quantiles[len(quantiles) // 2]),
+                                      float(quantiles[0]), float(quantiles[-1]), years)
+    return stats
+
+
+def day_name(day):
+    """
+    Returns the calendar day numbered by day_of_year as a date such as Oct 18.
+    """
+    return f'{datetime.date(2000, 1, 1) + datetime.timedelta(days=int(day)):%b %d}'
@@ -1,12 +1,43 @@
+import asyncio
+import datetime
+import json
 import logging
-import requests
 
+import aiohttp
+
+from . import fetch_policy, http_cache, metrics, rdb
+from .series import StationSeries, format_cfs
 from ..db import db
 
+BASE_URL = 'https://waterservices.usgs.gov/nwis'
 HEADERS = {
     'Accept-Encoding': 'gzip,deflate',
 }
 
+# Connection pool shared by every request to the USGS water services. Connections are kept alive between requests
+# and the per-host limit keeps a burst of reports from opening dozens of sockets to waterservices.usgs.gov at once.
+POOL_LIMIT = 20
+POOL_LIMIT_PER_HOST = 6
+KEEPALIVE_TIMEOUT = 60
+TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=20)
+# History responses are only bounded by the attempt timeout, as long as they keep arriving
+HISTORY_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_read=20)
+# How long a fetch waits for other reports to join it before the combined request is sent to USGS
+COALESCE_WINDOW = 0.05
+# Upper bound on the sites merged into one request so coalesced batches stay within what USGS will answer
+MAX_SITES_PER_REQUEST = 100
+# Earliest date asked for when a report covers a station's whole period of record
+RECORD_START = datetime.date(1850, 1, 1)
+# USGS revises provisional values and fills in missing days (e.g. under ice) for months after they're first
+# published. Revisions are requested for this many trailing days of stations still holding such values.
+REVISION_DAYS = 180
+# Requests spanning more days than this are history backfills. They are sent one site per request through their own
+# circuit breaker with a longer timeout, so a slow century of values can't hold up or trip everyday report requests.
+LONG_RANGE_DAYS = 366
+# History requests sent at once. Kept below POOL_LIMIT_PER_HOST so reports always find a free connection, and queued
+# requests wait here rather than for a connection, which would count against their connect timeout.
+HISTORY_CONCURRENCY = 3
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
@@ -23,62 +54,393 @@ ch.setFormatter(formatter)
 # add ch to logger
 logger.addHandler(ch)
 
+_session = None
+_history_slots = None
+# Refreshes in progress keyed by (site, start date, end date), shared by every report that needs the same values
+_inflight = {}
+# Refreshes waiting for the coalescing window to close before being sent as one request
+_batch = {}
+_batch_handle = None
+
+
+def get_session():
+    """
+    Returns the shared aiohttp session, creating it on first use. Must be called from within the running event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_LIMIT, limit_per_host=POOL_LIMIT_PER_HOST,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, headers=HEADERS, timeout=TIMEOUT)
+    return _session
+
+
+def history_slots():
+    global _history_slots
+    if _history_slots is None:
+        _history_slots = asyncio.Semaphore(HISTORY_CONCURRENCY)
+    return _history_slots
+
+
+async def close_session():
+    global _session, _history_slots
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _history_slots = None
+
+
+async def fetch_json(url):
+    """
+    Requests the given USGS water services url and returns the decoded json body, or None if the request failed.
+    Responses are served from the response cache until USGS next publishes new values.
+    """
+    cached = await http_cache.lookup(url)
+    if http_cache.is_fresh(cached):
+        metrics.increment('http_cache_hits')
+        return json.loads(cached.body)
+
+    async def attempt():
+        metrics.increment('usgs_requests')
+        with metrics.span('usgs_request'):
+            async with get_session().get(url, headers=http_cache.conditional_headers(cached)) as response:
+                if response.status == 304 and cached is not None:
+                    metrics.increment('http_cache_revalidated')
+                    await http_cache.revalidated(url, response.headers)
+                    return json.loads(cached.body)
+                if response.status == 200:
+                    body = await response.read()
+                    await http_cache.store(url, body, response.headers)
+                    return json.loads(body)
+                if fetch_policy.should_retry(response.status):
+                    raise fetch_policy.UpstreamError(f'USGS request {url} returned status {response.status}')
+                logger.debug(f'USGS request {url} returned status {response.status}')
+
+    try:
+        return await fetch_policy.call('dv', attempt)
+    except fetch_policy.RETRYABLE as e:
+        metrics.increment('usgs_errors')
+        logger.warning(f'USGS request {url} failed: {e!r}')
+
 
-def check_site_existence(station_id):
-    response = requests.get(
-        'https://waterservices.usgs.gov/nwis/dv/?format=json&site={site}'.format(site=station_id),
-        headers=HEADERS
-    )
-    if response.status_code == 200:
-        content = response.json()
+async def check_site_existence(station_id):
+    content = await fetch_json(f'{BASE_URL}/dv/?format=json&site={station_id}')
+    if content and content['value']['timeSeries']:
         return content['value']['timeSeries'][0]['sourceInfo']['siteName']
 
 
-def get_latest_values(json_data):
+def get_latest_values(series_list):
     """
-    Creates and returns a list of tuples matching station ID to the latest streamflow reading from the given json_data.
-    :param json_data: Dictionary of streamflow data pulled from the USGS waterdata service.
-    :return: list of tuples [(x, y), ...] where x equals the station ID and y equals the most recent CFS value in the
-    given json_data
+    Creates and returns a list of tuples matching station ID to the latest streamflow reading in the given series.
+    :param series_list: list of StationSeries as returned by get_daily_site_data.
+    :return: list of tuples [(x, y), ...] where x equals the station ID and y equals the most recent CFS value
+    formatted for display
     """
-    latest_data = []
-    for station_data in json_data['value']['timeSeries']:
-        latest_data.append(([station_data['sourceInfo']['siteCode'][0]['value']], station_data['values'][0]['value'][-1]['value']))
-    return latest_data
+    return [(series.station_id, format_cfs(series.latest_value)) for series in series_list]
 
 
-def get_station_name(station_id: int):
+async def get_station_name(station_id: int):
     logger.debug(f'Checking if station {station_id} exists in the database already')
-    station_name = db.record('SELECT StationName FROM stations WHERE StationID = ?', station_id)
+    station_name = await db.record('SELECT StationName FROM stations WHERE StationID = ?', station_id)
     if station_name:
         station_name = station_name[0]  # Unpack from single element tuple
         logger.debug(f'Found matching database record for station ID {station_id}. Station name: {station_name}')
         return station_name
     else:
-        logger.debug(f'Checking if station {station_id} exists in the USGS water data service')
-        station_name = check_site_existence(station_id)
+        logger.debug(f'Checking if station {station_id} exists in the local site index')
+        station_name = await db.field('SELECT StationName FROM sites WHERE StationID = ?', station_id)
+        # The index only holds streams and may be missing states whose import failed, so ask USGS about the rest
+        if station_name is None:
+            logger.debug(f'Checking if station {station_id} exists in the USGS water data service')
+            station_name = await check_site_existence(station_id)
         if station_name:
             logger.debug(f'Adding station {station_name} with ID {station_id} to database')
-            db.execute('INSERT INTO stations (StationID, StationName) VALUES (?, ?)', station_id, station_name)
+            await db.execute('INSERT INTO stations (StationID, StationName) VALUES (?, ?)', station_id, station_name)
             return station_name
 
 
-def get_daily_site_data(sites: list):
+async def _store_series(series):
+    """
+    Saves a station's daily values parsed from a USGS response to the observations table and records its name.
+    """
+    station_id = int(series.site_no)
+    if series.site_name:
+        await db.execute('INSERT OR IGNORE INTO stations (StationID, StationName) VALUES (?, ?)',
+                         station_id, series.site_name)
+    await db.multiexec('INSERT OR REPLACE INTO observations (StationID, ObsDate, Value, Qualifiers) '
+                       'VALUES (?, ?, ?, ?)',
+                       zip((station_id for _ in series.dates), series.dates, series.values, series.qualifiers))
+
+
+async def _load_series(sites, start_date):
+    """
+    Loads the stored values since start_date for each of the given sites, in the order the sites were given.
+    Sites without any stored values are left out.
+    """
+    station_ids = [int(site) for site in sites]
+    placeholders = ','.join('?' * len(station_ids))
+    names = dict(await db.records(f'SELECT StationID, StationName FROM stations WHERE StationID IN ({placeholders})',
+                                  *station_ids))
+    rows = {}
+    for station_id, obs_date, value, qualifiers in await db.records(
+            'SELECT StationID, ObsDate, Value, Qualifiers FROM observations '
+            f'WHERE StationID IN ({placeholders}) AND ObsDate >= ? ORDER BY StationID, ObsDate',
+            *station_ids, start_date.isoformat()):
+        rows.setdefault(station_id, []).append((obs_date, value, qualifiers))
+
+    return [StationSeries.from_rows(station_id, names.get(station_id), rows[station_id])
+            for station_id in station_ids if station_id in rows]
+
+
+class _Recording(object):
+    """
+    Passes the lines of a response stream through while keeping a copy of each for the response cache. The copy is
+    dropped as soon as it grows past max_bytes, so large responses are still only held a line at a time.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = http_cache.MAX_BODY_BYTES if max_bytes is None else max_bytes
+        self.size = 0
+        # None once the response has outgrown max_bytes
+        self.lines = []
+
+    async def tee(self, stream):
+        async for line in stream:
+            if self.lines is not None:
+                self.size += len(line)
+                if self.size > self.max_bytes:
+                    self.lines = None
+                else:
+                    self.lines.append(line)
+            yield line
+
+
+def _endpoint(start_date, end_date=None):
+    """
+    Returns the name of the circuit breaker guarding requests for values from start_date through end_date.
+    """
+    if ((end_date or datetime.date.today()) - start_date).days > LONG_RANGE_DAYS:
+        return 'history'
+    return 'dv'
+
+
+async def _fetch_daily_values(sites, start_date, end_date=None):
+    """
+    Requests the daily values from start_date through end_date (or the latest value) for the given sites in the
+    compact RDB format and stores each station's values as soon as its rows have been read from the response. A
+    cached response for the same query is used instead while it's fresh, and revalidated with a conditional request
+    once it isn't. A response is only cached once its values are stored, so a cached response needn't be stored
+    again. History backfills and responses larger than http_cache.MAX_BODY_BYTES aren't cached.
+    :return: True if the values are up to date, False if USGS couldn't be reached
+    """
     # USGS data filter docs: https://waterservices.usgs.gov/rest/Site-Service.html
-    logger.debug(f'Getting CFS data for {sites}')
+    # parameterCd 00060 filters for discharge, cubic feet per second
     if len(sites) == 1:
-        site = sites[0]
-        # parameterCd 00060 filters for discharge, cubic feet per second
-        response = requests.get(
-            f'https://waterservices.usgs.gov/nwis/dv/?format=json&parameterCd=00060&period=P30D&site={site}',
-            headers=HEADERS
-        )
+        url = f'{BASE_URL}/dv/?format=rdb&parameterCd=00060&startDT={start_date:%Y-%m-%d}&site={sites[0]}'
     else:
-        response = requests.get(
-            'https://waterservices.usgs.gov/nwis/dv/?format=json&parameterCd=00060&period=P30D&sites={sites}'
-                .format(sites=','.join(str(site) for site in sites)),
-            headers=HEADERS
-        )
-
-    if response.status_code == 200:
-        return response.json()
+        url = '{base}/dv/?format=rdb&parameterCd=00060&startDT={start:%Y-%m-%d}&sites={sites}'.format(
+            base=BASE_URL, start=start_date, sites=','.join(str(site) for site in sites))
+    if end_date is not None:
+        url += f'&endDT={end_date:%Y-%m-%d}'
+    endpoint = _endpoint(start_date, end_date)
+    history = endpoint == 'history'
+
+    # History responses can run to hundreds of megabytes and their values are kept in the observations table anyway
+    cached = None if history else await http_cache.lookup(url)
+    if http_cache.is_fresh(cached):
+        metrics.increment('http_cache_hits')
+        return True
+
+    async def attempt():
+        stores = []
+        metrics.increment('usgs_requests')
+        try:
+            with metrics.span('usgs_request'):
+                async with get_session().get(url, headers=http_cache.conditional_headers(cached),
+                                             timeout=HISTORY_TIMEOUT if history else TIMEOUT) as response:
+                    if response.status == 304 and cached is not None:
+                        metrics.increment('http_cache_revalidated')
+                        await http_cache.revalidated(url, response.headers)
+                        return
+                    if fetch_policy.should_retry(response.status):
+                        raise fetch_policy.UpstreamError(f'USGS request {url} returned status {response.status}')
+                    if response.status != 200:
+                        # USGS answers 404 when there are no values in the requested period
+                        logger.debug(f'USGS request {url} returned status {response.status}')
+                        return
+                    recording = None if history else _Recording()
+                    async for series in rdb.parse_rdb_stream(recording.tee(response.content) if recording
+                                                             else response.content):
+                        # Keep reading while the values are journaled so every station lands in the same group commit
+                        stores.append(asyncio.ensure_future(_store_series(series)))
+                    await asyncio.gather(*stores)
+                    if recording is not None and recording.lines is not None:
+                        await http_cache.store(url, b''.join(recording.lines), response.headers)
+        finally:
+            # Values read before a failure are kept, a retry simply stores them again
+            await asyncio.gather(*stores)
+
+    try:
+        if history:
+            async with history_slots():
+                await fetch_policy.call(endpoint, attempt, timeout=fetch_policy.HISTORY_TIMEOUT)
+        else:
+            await fetch_policy.call(endpoint, attempt)
+        return True
+    except fetch_policy.CircuitOpen:
+        logger.debug(f'Not requesting {url} while USGS is failing')
+    except fetch_policy.RETRYABLE as e:
+        metrics.increment('usgs_errors')
+        logger.warning(f'USGS request {url} failed: {e!r}')
+    return False
+
+
+async def _fetch_group(start_date, end_date, sites, futures):
+    refreshed = False
+    try:
+        logger.debug(f'Requesting values from {start_date} to {end_date or "now"} for {sites} from USGS')
+        refreshed = await _fetch_daily_values(sites, start_date, end_date)
+    except Exception:
+        logger.exception(f'Failed to refresh values for {sites}')
+    finally:
+        for future in futures:
+            if not future.done():
+                future.set_result(refreshed)
+
+
+def _flush_batch():
+    global _batch, _batch_handle
+    batch, _batch, _batch_handle = _batch, {}, None
+
+    groups = {}
+    for (site, start_date, end_date), future in batch.items():
+        sites, futures = groups.setdefault((start_date, end_date), ([], []))
+        sites.append(site)
+        futures.append(future)
+    for (start_date, end_date), (sites, futures) in groups.items():
+        per_request = 1 if _endpoint(start_date, end_date) == 'history' else MAX_SITES_PER_REQUEST
+        for i in range(0, len(sites), per_request):
+            asyncio.ensure_future(_fetch_group(start_date, end_date, sites[i:i + per_request],
+                                               futures[i:i + per_request]))
+
+
+def _refresh(site, start_date, end_date=None):
+    """
+    Returns a future resolved with True once the site's values from start_date through end_date (or the latest
+    value) have been fetched and stored, or False if they couldn't be. Requests for the same values share one
+    fetch, and every site requested within the coalescing window is merged into a single multi-site request per
+    date range. History backfills are requested one site at a time instead.
+    """
+    global _batch_handle
+    key = (int(site), start_date, end_date)
+    if key not in _inflight:
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+        _inflight[key] = _batch[key] = future
+        if _batch_handle is None:
+            _batch_handle = asyncio.get_event_loop().call_later(COALESCE_WINDOW, _flush_batch)
+    return asyncio.shield(_inflight[key])
+
+
+def _plan_refreshes(window_start, today, first_date, last_date, covered_from, revise_from=None):
+    """
+    Works out which date ranges of a station have to be requested for its values to cover window_start onwards.
+    :param first_date: first stored date of the station, None if nothing is stored.
+    :param last_date: last stored date of the station.
+    :param covered_from: date from which the stored values are known to be complete, if recorded.
+    :param revise_from: date from which stored values are asked for again so USGS revisions replace them, if any.
+    :return: tuple (ranges, covered) with the list of (start date, end date or None for the latest value) ranges to
+    request and the date the stored values will be complete from once they have been, or None if that doesn't change
+    """
+    one_day = datetime.timedelta(days=1)
+    if last_date is None or last_date < window_start - one_day:
+        # Nothing stored in the window, or only older values with a gap before it, so fetch the whole window
+        return [(window_start, None)], window_start
+
+    ranges = []
+    if revise_from is not None and revise_from <= last_date:
+        ranges.append((revise_from, None))
+    # Daily values are published the day after they're measured
+    elif last_date + one_day < today:
+        ranges.append((last_date + one_day, None))
+    # Databases from before coverage was tracked are taken to be complete from their first stored value
+    covered_from = covered_from or first_date
+    if window_start < covered_from:
+        ranges.append((window_start, covered_from - one_day))
+        return ranges, window_start
+    return ranges, None
+
+
+@metrics.timed('get_daily_site_data')
+async def get_daily_site_data(sites: list, days: int = 30, revise: bool = False):
+    """
+    Returns the last `days` days of daily streamflow values for the given sites. Values already stored in the
+    observations table are served locally. USGS is only asked for the days missing since the last stored value and
+    for any earlier history the window reaches back to that hasn't been stored yet.
+    When USGS can't be reached, or is skipped because it has been failing, the stored values are returned with the
+    series marked stale.
+    :param days: number of days to return, or None for each station's whole period of record.
+    :param revise: also ask again for the last REVISION_DAYS days of stations with provisional or missing values in
+    that time, so they're replaced once USGS revises them.
+    :return: list of StationSeries in the order of the given sites, leaving out sites without any values
+    """
+    logger.debug(f'Getting CFS data for {sites}')
+    if not sites:
+        return []
+    today = datetime.date.today()
+    if days is None or days >= (today - RECORD_START).days:
+        window_start = RECORD_START
+    else:
+        window_start = today - datetime.timedelta(days=days)
+
+    # Shared by every station so their revisions are requested together
+    revision_start = today - datetime.timedelta(days=REVISION_DAYS)
+    station_ids = [int(site) for site in sites]
+    stored = {}
+    revise_from = {}
+    for station_id, first_date, last_date, covered_from, provisional, revision_count in await db.records(
+            'SELECT observations.StationID, MIN(ObsDate), MAX(ObsDate), FirstDate, '
+            "MAX(ObsDate >= ?1 AND ',' || Qualifiers || ',' LIKE '%,P,%'), SUM(ObsDate >= ?1) FROM observations "
+            'LEFT JOIN coverage ON coverage.StationID = observations.StationID '
+            'WHERE observations.StationID IN ({}) GROUP BY observations.StationID'.format(
+                ','.join('?' * len(station_ids))), revision_start.isoformat(), *station_ids):
+        stored[station_id] = tuple(date and datetime.date.fromisoformat(date)
+                                   for date in (first_date, last_date, covered_from))
+        first_date, last_date = stored[station_id][:2]
+        # Days missing between the revision window's start and the last stored value, e.g. reported as "Ice"
+        missing = revision_count < (last_date - max(first_date, revision_start)).days + 1
+        if revise and (provisional or missing):
+            revise_from[station_id] = revision_start
+
+    refreshes = []
+    stale = set()
+    for station_id in station_ids:
+        ranges, covered = _plan_refreshes(window_start, today, *stored.get(station_id, (None, None, None)),
+                                          revise_from=revise_from.get(station_id))
+        if not ranges:
+            continue
+        # Don't make reports wait out the coalescing window for a request that would be refused anyway
+        if any(fetch_policy.breaker(_endpoint(start, end)).is_open for start, end in ranges):
+            stale.add(station_id)
+        else:
+            refreshes.append((station_id, covered, [_refresh(station_id, start, end) for start, end in ranges]))
+    metrics.increment('observations_local', len(station_ids) - len(refreshes) - len(stale))
+    metrics.increment('observations_refreshed', len(refreshes))
+
+    refreshed = await asyncio.gather(*(asyncio.gather(*futures) for _, _, futures in refreshes))
+    coverage = []
+    for (station_id, covered, _), results in zip(refreshes, refreshed):
+        if not all(results):
+            stale.add(station_id)
+        elif covered is not None:
+            coverage.append((station_id, covered.isoformat()))
+    if coverage:
+        await db.multiexec('INSERT OR REPLACE INTO coverage (StationID, FirstDate) VALUES (?, ?)', coverage,
+                           wait=False)
+
+    series_list = await _load_series(sites, window_start)
+    for series in series_list:
+        series.stale = series.station_id in stale
+    if stale:
+        metrics.increment('observations_stale', len(stale))
+    return series_list
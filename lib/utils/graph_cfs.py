@@ -1,31 +1,124 @@
-import datetime
+import io
 
-from bokeh.plotting import figure
+from .series import StationSeries
 
-from .get_cfs_data import get_station_name
+CHART_WIDTH = 800
+CHART_HEIGHT = 300
+# Size of each chart in a multi-station report page
+PANEL_WIDTH = 400
+PANEL_HEIGHT = 220
+BACKENDS = ('pillow', 'bokeh')
 
 
-def create_line_charts(json_data):
-    figs = []
-    for station_data in json_data['value']['timeSeries']:
-        if 'Streamflow' in station_data['variable']['variableName']:
-            cfs_values = []
-            time_values = []
-            for data_value in station_data['values'][0]['value']:
-                cfs_values.append(data_value['value'])
-                time_values.append(datetime.datetime.strptime(data_value['dateTime'][:10], '%Y-%m-%d'))
+def create_line_chart(title, dates, cfs_values, width=CHART_WIDTH, height=CHART_HEIGHT, x_range=None,
+                      y_axis_label="Streamflow Rate (Cubic Feet/Second)"):
+    from bokeh.plotting import figure
 
-            fig = figure(
-                title=get_station_name(station_data['sourceInfo']['siteCode'][0]['value']),
-                plot_width=800,
-                plot_height=300,
-                x_axis_type="datetime",
-                x_axis_label="Date",
-                y_axis_label="Streamflow Rate (Cubic Feet/Second)",
-                tools=[]  # Users only see the PNG export so no point in including tool icons
-            )
-            fig.line(time_values, cfs_values, color='navy', alpha=0.5)
+    fig = figure(
+        title=title,
+        plot_width=width,
+        plot_height=height,
+        x_axis_type="datetime",
+        x_axis_label="Date",
+        y_axis_label=y_axis_label,
+        tools=[]  # Users only see the PNG export so no point in including tool icons
+    )
+    if x_range is not None:
+        fig.x_range = x_range
+    fig.line(dates, cfs_values, color='navy', alpha=0.5)
+    return fig
 
-            figs.append(fig)
 
-    return figs
+def paginate(series_list, per_page):
+    return [series_list[i:i + per_page] for i in range(0, len(series_list), per_page)]
+
+
+def shared_date_range(series_list):
+    """
+    Returns the (start, end) dates covering every one of the given StationSeries.
+    """
+    dated = [series for series in series_list if len(series)]
+    if not dated:
+        return None
+    return min(series.dates[0] for series in dated), max(series.dates[-1] for series in dated)
+
+
+def create_panel_chart(series_list, columns=2):
+    """
+    Creates a bokeh grid of small charts, one per StationSeries, sharing a single date axis.
+    """
+    from bokeh.layouts import gridplot
+    from bokeh.models import Range1d
+
+    shared_range = None
+    if shared_date_range(series_list):
+        start, end = (date.astype('datetime64[ms]').astype(object) for date in shared_date_range(series_list))
+        shared_range = Range1d(start, end)
+    figs = [create_line_chart(series.site_name, series.dates, series.values, width=PANEL_WIDTH, height=PANEL_HEIGHT,
+                              x_range=shared_range, y_axis_label='CFS')
+            for series in series_list]
+    return gridplot(figs, ncols=columns, toolbar_location=None)
+
+
+def create_line_charts(series_list, per_page=None, columns=2):
+    """
+    Creates a bokeh figure for each of the given StationSeries, or when per_page is given, one grid of small charts
+    for each page of per_page stations.
+    """
+    if per_page:
+        return [create_panel_chart(page, columns=columns) for page in paginate(series_list, per_page)]
+    return [create_line_chart(series.site_name, series.dates, series.values) for series in series_list]
+
+
+def export_png_bytes(fig):
+    """
+    Exports a bokeh figure to PNG bytes. This drives a headless browser through selenium so it is slow.
+    """
+    from bokeh.io.export import get_screenshot_as_png
+
+    buffer = io.BytesIO()
+    get_screenshot_as_png(fig).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def render_line_chart(title, dates, cfs_values, backend='pillow'):
+    """
+    Renders a streamflow line chart to PNG bytes.
+    :param dates: datetime64[D] array of dates for the x axis.
+    :param cfs_values: float array of CFS values matching dates.
+    :param backend: 'pillow' draws the chart in process, 'bokeh' exports a bokeh figure through a headless browser.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown chart backend {backend!r}, expected one of {BACKENDS}')
+    if backend == 'bokeh':
+        return export_png_bytes(create_line_chart(title, dates, cfs_values))
+    # Pillow is only loaded where charts are drawn, which is normally the render worker processes
+    from . import png_chart
+
+    return png_chart.render_line_chart(title, dates, cfs_values, width=CHART_WIDTH, height=CHART_HEIGHT)
+
+
+def render_panel_page(panels, date_range=None, columns=2, backend='pillow'):
+    """
+    Renders several stations as small charts tiled into one PNG image.
+    :param panels: list of (title, dates, values) tuples, one per station.
+    :param date_range: (start, end) dates shared by every panel, defaults to the range covering all of them.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown chart backend {backend!r}, expected one of {BACKENDS}')
+    if backend == 'bokeh':
+        series_list = [StationSeries(0, title, dates, values) for title, dates, values in panels]
+        return export_png_bytes(create_panel_chart(series_list, columns=columns))
+    from . import png_chart
+
+    return png_chart.render_panel_page(panels, date_range=date_range, columns=columns, panel_width=PANEL_WIDTH,
+                                       panel_height=PANEL_HEIGHT)
+
+
+def render_line_charts(series_list, backend='pillow'):
+    """
+    Renders a streamflow line chart for each of the given StationSeries.
+    :return: list of PNG images as bytes
+    """
+    return [render_line_chart(series.site_name, series.dates, series.values, backend=backend)
+            for series in series_list]
@@ -0,0 +1,119 @@
+import datetime
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from ..db import db
+
+# UTC hour by which USGS has usually published the previous day's daily values. Responses are kept until the next
+# publication since asking again before then can't return anything new.
+PUBLISH_HOUR = 10
+# Values for the previous day keep trickling in for a few hours after the publication hour, so responses fetched
+# during that window are only kept for WINDOW_TTL seconds
+PUBLISH_WINDOW_HOURS = 6
+WINDOW_TTL = 30 * 60
+# Expired responses are kept this long so they can still be revalidated with a conditional request
+KEEP_EXPIRED = 7 * 24 * 60 * 60
+COMPRESSION_LEVEL = 6
+# Largest response body, before compression, worth keeping. Bigger responses would have to be held in memory whole
+# while they stream in.
+MAX_BODY_BYTES = 4 * 1024 * 1024
+# Query parameters holding comma separated lists whose order doesn't change the response
+LIST_PARAMETERS = ('sites', 'parameterCd', 'stateCd')
+
+CachedResponse = namedtuple('CachedResponse', ['body', 'etag', 'last_modified', 'expires_at'])
+
+
+def configure(publish_hour=PUBLISH_HOUR, publish_window_hours=PUBLISH_WINDOW_HOURS):
+    global PUBLISH_HOUR, PUBLISH_WINDOW_HOURS
+    PUBLISH_HOUR = publish_hour
+    PUBLISH_WINDOW_HOURS = publish_window_hours
+
+
+def cache_key(url):
+    """
+    Normalizes a USGS water services url so equivalent queries share one cache entry: parameters are sorted by
+    name, site= is folded into sites= and list parameters are sorted, e.g. ...&sites=2,1 and ...&site=1,2 match.
+    """
+    parts = urlsplit(url)
+    query = {}
+    for name, value in parse_qsl(parts.query, keep_blank_values=True):
+        name = 'sites' if name == 'site' else name
+        if name in LIST_PARAMETERS:
+            value = ','.join(sorted(set(value.split(','))))
+        query[name] = value
+    return f'{parts.netloc}{parts.path}?{urlencode(sorted(query.items()), safe=",")}'
+
+
+def expires_at(now=None):
+    """
+    Returns when a response received at `now` (a unix timestamp, defaults to the current time) should expire,
+    following the daily values publication schedule.
+    """
+    now = time.time() if now is None else now
+    current = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+    published = current.replace(hour=PUBLISH_HOUR, minute=0, second=0, microsecond=0)
+    if current < published:
+        return published.timestamp()
+    if current < published + datetime.timedelta(hours=PUBLISH_WINDOW_HOURS):
+        return now + WINDOW_TTL
+    return (published + datetime.timedelta(days=1)).timestamp()
+
+
+def is_fresh(cached):
+    return cached is not None and cached.expires_at > time.time()
+
+
+async def lookup(url):
+    """
+    :return: the CachedResponse stored for the url's query, fresh or not, or None if nothing is stored
+    """
+    row = await db.record('SELECT Body, ETag, LastModified, ExpiresAt FROM http_cache WHERE CacheKey = ?',
+                          cache_key(url))
+    if row is None:
+        return None
+    body, etag, last_modified, expires = row
+    return CachedResponse(zlib.decompress(body), etag, last_modified, expires)
+
+
+def conditional_headers(cached):
+    """
+    Returns the headers asking the server to only send the response again if it has changed since cached.
+    """
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+    return headers
+
+
+async def store(url, body, headers):
+    """
+    Stores a response body compressed, along with the validators from its headers.
+    """
+    now = time.time()
+    await db.execute('INSERT OR REPLACE INTO http_cache (CacheKey, Body, ETag, LastModified, FetchedAt, ExpiresAt) '
+                     'VALUES (?, ?, ?, ?, ?, ?)',
+                     cache_key(url), zlib.compress(body, COMPRESSION_LEVEL), headers.get('ETag'),
+                     headers.get('Last-Modified'), now, expires_at(now), wait=False)
+
+
+async def revalidated(url, headers):
+    """
+    Renews a stored response after the server answered a conditional request with 304 Not Modified.
+    """
+    now = time.time()
+    await db.execute('UPDATE http_cache SET ETag = COALESCE(?, ETag), LastModified = COALESCE(?, LastModified), '
+                     'FetchedAt = ?, ExpiresAt = ? WHERE CacheKey = ?',
+                     headers.get('ETag'), headers.get('Last-Modified'), now, expires_at(now), cache_key(url),
+                     wait=False)
+
+
+async def prune():
+    """
+    Deletes responses that expired too long ago to be worth revalidating.
+    """
+    await db.execute('DELETE FROM http_cache WHERE ExpiresAt < ?', time.time() - KEEP_EXPIRED)
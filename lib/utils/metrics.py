@@ -0,0 +1,207 @@
+import bisect
+import functools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Prefix of every metric name in the Prometheus exposition
+NAMESPACE = 'cfs_bot'
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Most recent observations kept per histogram for the percentiles shown by !stats
+RESERVOIR_SIZE = 1024
+
+_histograms = {}
+_counters = {}
+_gauges = {}
+# Guards the registries, observations also arrive from the database threads
+_lock = threading.Lock()
+_runner = None
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets for export, plus a window of recent observations for percentiles.
+    """
+
+    def __init__(self, name, description='', buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, value):
+        with _lock:
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.recent.append(value)
+
+    def percentile(self, q):
+        """
+        Returns the q-th percentile (0-100) of the recent observations, or None if there are none.
+        """
+        with _lock:
+            recent = sorted(self.recent)
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, int(round(q / 100 * (len(recent) - 1))))]
+
+
+class Counter(object):
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def increment(self, amount=1):
+        with _lock:
+            self.value += amount
+
+
+def histogram(name, description=''):
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(name, description)
+        return _histograms[name]
+
+
+def counter(name, description=''):
+    with _lock:
+        if name not in _counters:
+            _counters[name] = Counter(name, description)
+        return _counters[name]
+
+
+def gauge(name, read, description=''):
+    """
+    Registers a value read from elsewhere each time the metrics are reported.
+    :param read: function returning the current value.
+    """
+    with _lock:
+        _gauges[name] = (read, description)
+
+
+def observe(name, seconds):
+    histogram(name).observe(seconds)
+
+
+def increment(name, amount=1):
+    counter(name).increment(amount)
+
+
+@contextmanager
+def span(name):
+    """
+    Times the enclosed block, async or not, into the named latency histogram.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a coroutine function into the named latency histogram.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def inner(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return inner
+
+    return decorator
+
+
+def snapshot():
+    """
+    :return: tuple (histograms, counters), histograms as a list of (name, count, p50, p95) in seconds and counters,
+    gauges included, as a list of (name, value), both sorted by name
+    """
+    with _lock:
+        histograms = sorted(_histograms.values(), key=lambda h: h.name)
+        counters = [(c.name, c.value) for c in _counters.values()]
+        gauges = [(name, read) for name, (read, _) in _gauges.items()]
+    return ([(h.name, h.count, h.percentile(50), h.percentile(95)) for h in histograms],
+            sorted(counters + [(name, read()) for name, read in gauges]))
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition():
+    """
+    Renders every metric in the Prometheus text exposition format.
+    """
+    with _lock:
+        histograms = [(h.name, h.description, h.buckets, list(h.bucket_counts), h.count, h.sum)
+                      for h in _histograms.values()]
+        counters = [(c.name, c.description, c.value) for c in _counters.values()]
+        gauges = list(_gauges.items())
+
+    lines = []
+    for name, description, buckets, bucket_counts, count, total in sorted(histograms):
+        metric = f'{NAMESPACE}_{name}_seconds'
+        lines.append(f'# HELP {metric} {description or name.replace("_", " ")}')
+        lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{le="+Inf"}} {count}')
+        lines.append(f'{metric}_sum {_format_value(total)}')
+        lines.append(f'{metric}_count {count}')
+    for name, description, value in sorted(counters):
+        metric = f'{NAMESPACE}_{name}_total'
+        lines.append(f'# HELP {metric} {description or name.replace("_", " ")}')
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {_format_value(value)}')
+    for name, (read, description) in sorted(gauges, key=lambda item: item[0]):
+        metric = f'{NAMESPACE}_{name}'
+        lines.append(f'# HELP {metric} {description or name.replace("_", " ")}')
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric} {_format_value(read())}')
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle_metrics(request):
+    from aiohttp import web
+
+    return web.Response(body=exposition().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_server(port, host='127.0.0.1'):
+    """
+    Serves the metrics for Prometheus to scrape at http://host:port/metrics.
+    """
+    # Only needed when the metrics are exported, so the server side of aiohttp isn't imported otherwise
+    from aiohttp import web
+
+    global _runner
+    if _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+    _runner = None
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from . import metrics
+
+# Discord allows at most 10 attachments on a single message
+MAX_FILES_PER_MESSAGE = 10
+
+
+class _ChannelQueue(object):
+    """
+    Messages waiting to be sent to one channel, queued per user so users take turns.
+    """
+
+    def __init__(self):
+        self.users = OrderedDict()
+        self.sent_at = deque()
+        self.worker = None
+
+    def push(self, user_id, job):
+        self.users.setdefault(user_id, deque()).append(job)
+
+    def pop(self):
+        """
+        Returns the next message of the user at the front of the rotation and moves that user to the back.
+        """
+        user_id, jobs = next(iter(self.users.items()))
+        job = jobs.popleft()
+        del self.users[user_id]
+        if jobs:
+            self.users[user_id] = jobs
+        return job
+
+
+class Outbox(object):
+    """
+    Sends messages through a per-channel queue that paces itself to stay under Discord's per-channel rate limit
+    rather than running into 429 responses, and shares each channel fairly between the users sending to it.
+    """
+
+    def __init__(self, rate=5, per=5.0):
+        """
+        :param rate: number of messages allowed per channel in each window.
+        :param per: length of the rate limit window in seconds.
+        """
+        self.rate = rate
+        self.per = per
+        self._channels = {}
+
+    @staticmethod
+    def pack(content=None, embed=None, files=None):
+        """
+        Splits a message with any number of files into as few messages as possible, each carrying up to ten files.
+        The content and embed go with the first message.
+        :return: list of send() keyword arguments, one per message
+        """
+        files = list(files or [])
+        messages = [{'content': content, 'embed': embed, 'files': files[:MAX_FILES_PER_MESSAGE] or None}]
+        for i in range(MAX_FILES_PER_MESSAGE, len(files), MAX_FILES_PER_MESSAGE):
+            messages.append({'files': files[i:i + MAX_FILES_PER_MESSAGE]})
+        return messages
+
+    async def send(self, channel, user_id, content=None, embed=None, files=None):
+        """
+        Queues a message for the channel on behalf of the given user and waits for it to be delivered.
+        :param files: list of discord.File attachments, split across as many messages as needed.
+        :return: list of the sent discord.Message objects
+        """
+        loop = asyncio.get_event_loop()
+        queue = self._channels.setdefault(channel.id, _ChannelQueue())
+        futures = []
+        for kwargs in self.pack(content, embed, files):
+            future = loop.create_future()
+            queue.push(user_id, (channel, kwargs, future))
+            futures.append(future)
+        if queue.worker is None:
+            queue.worker = asyncio.ensure_future(self._drain(queue))
+        return list(await asyncio.gather(*futures))
+
+    async def _wait_for_slot(self, queue):
+        now = time.monotonic()
+        while queue.sent_at and now - queue.sent_at[0] >= self.per:
+            queue.sent_at.popleft()
+        if len(queue.sent_at) >= self.rate:
+            await asyncio.sleep(queue.sent_at[0] + self.per - now)
+            queue.sent_at.popleft()
+        queue.sent_at.append(time.monotonic())
+
+    async def _drain(self, queue):
+        try:
+            while queue.users:
+                channel, kwargs, future = queue.pop()
+                if future.done():
+                    continue
+                with metrics.span('outbox_pacing'):
+                    await self._wait_for_slot(queue)
+                try:
+                    with metrics.span('discord_send'):
+                        message = await channel.send(**kwargs)
+                    if not future.done():
+                        future.set_result(message)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+        finally:
+            # The queue is kept after draining so its send history still paces the channel's next messages
+            queue.worker = None
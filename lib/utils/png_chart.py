@@ -0,0 +1,200 @@
+import datetime
+import io
+import math
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+BACKGROUND = (255, 255, 255)
+AXIS_COLOR = (68, 68, 68)
+GRID_COLOR = (229, 229, 229)
+TEXT_COLOR = (68, 68, 68)
+# Navy drawn at 50% opacity over the white background, matching the bokeh chart
+LINE_COLOR = (127, 127, 191)
+
+# Day spacings tried, smallest first, when picking where to place the date ticks
+DATE_TICK_STEPS = (1, 2, 3, 5, 7, 14, 30, 61, 91, 182, 365, 730, 1826, 3652, 7305)
+
+
+def _load_font(size):
+    for name in ('DejaVuSans.ttf', 'Arial.ttf', 'LiberationSans-Regular.ttf'):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+FONT = _load_font(11)
+TITLE_FONT = _load_font(13)
+
+
+def _text_size(font, text):
+    if hasattr(font, 'getbbox'):
+        left, top, right, bottom = font.getbbox(text)
+        return right - left, bottom - top
+    return font.getsize(text)
+
+
+def nice_ticks(low, high, max_ticks=6):
+    """
+    Returns evenly spaced, human friendly tick values (steps of 1, 2 or 5 times a power of ten) covering low to high.
+    """
+    if high <= low:
+        high = low + 1
+    raw_step = (high - low) / max_ticks
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(m * magnitude for m in (1, 2, 5, 10) if m * magnitude >= raw_step)
+    first = math.floor(low / step) * step
+    last = math.ceil(high / step) * step
+    return [first + i * step for i in range(int(round((last - first) / step)) + 1)]
+
+
+def date_ticks(start, end, max_ticks=8):
+    """
+    Returns the dates between start and end (inclusive) to label on the x axis along with the strftime format to use.
+    """
+    span = (end - start).days
+    step = next((s for s in DATE_TICK_STEPS if span / s <= max_ticks), DATE_TICK_STEPS[-1])
+    if step >= 365:
+        ticks = [datetime.date(year, 1, 1) for year in range(start.year, end.year + 1)
+                 if (year - start.year) % (step // 365) == 0]
+        fmt = '%Y'
+    elif step >= 30:
+        months = step // 30
+        ticks = []
+        year, month = start.year, start.month
+        while datetime.date(year, month, 1) <= end:
+            ticks.append(datetime.date(year, month, 1))
+            month += months
+            year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+        fmt = '%m/%Y'
+    else:
+        ticks = [start + datetime.timedelta(days=d) for d in range(0, span + 1, step)]
+        fmt = '%m/%d'
+    return [tick for tick in ticks if start <= tick <= end], fmt
+
+
+def _format_tick(value):
+    return f'{value:,.0f}' if abs(value) >= 10 or float(value).is_integer() else f'{value:g}'
+
+
+def draw_line_chart(image, box, title, dates, values, x_label='Date',
+                    y_label='Streamflow Rate (Cubic Feet/Second)', date_range=None):
+    """
+    Draws a single streamflow line chart into the (left, top, right, bottom) box of the given PIL image.
+    :param dates: datetime64[D] array (or sequence of dates) for the x axis.
+    :param values: float array of CFS values matching dates, NaN values are skipped.
+    :param date_range: optional (start, end) dates for the x axis so several charts can share one axis range.
+    """
+    draw = ImageDraw.Draw(image)
+    left, top, right, bottom = box
+
+    draw.text((left + 8, top + 4), title or '', fill=TEXT_COLOR, font=TITLE_FONT)
+
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    dates, values = dates[valid], values[valid]
+
+    if date_range:
+        start, end = (np.datetime64(date, 'D') for date in date_range)
+    elif len(dates):
+        start, end = dates.min(), dates.max()
+    else:
+        start = end = np.datetime64(datetime.date.today(), 'D')
+    if end <= start:
+        end = start + np.timedelta64(1, 'D')
+    span = float((end - start).astype(np.int64))
+
+    y_ticks = nice_ticks(values.min() if len(values) else 0, values.max() if len(values) else 1)
+    tick_labels = [_format_tick(tick) for tick in y_ticks]
+    label_width = max(_text_size(FONT, label)[0] for label in tick_labels)
+    _, text_height = _text_size(FONT, '0123456789')
+
+    # Plot area inside the box, leaving room for the title, axis labels and tick labels
+    plot_left = left + text_height + label_width + 20
+    plot_top = top + text_height + 16
+    plot_right = right - 12
+    plot_bottom = bottom - 2 * text_height - 18
+
+    def x_pos(days):
+        return plot_left + days / span * (plot_right - plot_left)
+
+    def y_pos(value):
+        return plot_bottom - (value - y_ticks[0]) / (y_ticks[-1] - y_ticks[0]) * (plot_bottom - plot_top)
+
+    for tick, label in zip(y_ticks, tick_labels):
+        y = y_pos(tick)
+        draw.line([(plot_left, y), (plot_right, y)], fill=GRID_COLOR)
+        width, height = _text_size(FONT, label)
+        draw.text((plot_left - width - 6, y - height / 2 - 1), label, fill=TEXT_COLOR, font=FONT)
+
+    start_date = start.item()
+    x_ticks, fmt = date_ticks(start_date, end.item())
+    for tick in x_ticks:
+        x = x_pos((tick - start_date).days)
+        draw.line([(x, plot_top), (x, plot_bottom)], fill=GRID_COLOR)
+        draw.line([(x, plot_bottom), (x, plot_bottom + 4)], fill=AXIS_COLOR)
+        label = tick.strftime(fmt)
+        width, _ = _text_size(FONT, label)
+        draw.text((x - width / 2, plot_bottom + 6), label, fill=TEXT_COLOR, font=FONT)
+
+    draw.line([(plot_left, plot_top), (plot_left, plot_bottom), (plot_right, plot_bottom)], fill=AXIS_COLOR)
+
+    xs = x_pos((dates - start).astype(np.float64))
+    ys = y_pos(values)
+    if len(xs) > 1:
+        draw.line(list(zip(xs.tolist(), ys.tolist())), fill=LINE_COLOR, width=1)
+    elif len(xs):
+        x, y = xs[0], ys[0]
+        draw.ellipse([(x - 1, y - 1), (x + 1, y + 1)], fill=LINE_COLOR)
+
+    width, _ = _text_size(FONT, x_label)
+    draw.text(((plot_left + plot_right - width) / 2, bottom - text_height - 8), x_label, fill=TEXT_COLOR, font=FONT)
+
+    # PIL can't draw rotated text directly so draw the y axis label on its own image and rotate that
+    width, height = _text_size(FONT, y_label)
+    label_image = Image.new('RGB', (width + 2, height + 4), BACKGROUND)
+    ImageDraw.Draw(label_image).text((0, 0), y_label, fill=TEXT_COLOR, font=FONT)
+    label_image = label_image.rotate(90, expand=True)
+    image.paste(label_image, (left + 4, int((plot_top + plot_bottom - label_image.height) / 2)))
+
+
+def render_line_chart(title, dates, values, width=800, height=300):
+    """
+    Renders a streamflow line chart straight to PNG bytes without a browser.
+    :param dates: datetime64[D] array (or sequence of dates) for the x axis.
+    :param values: float array of CFS values matching dates.
+    """
+    image = Image.new('RGB', (width, height), BACKGROUND)
+    draw_line_chart(image, (0, 0, width, height), title, dates, values)
+    return to_png(image)
+
+
+def render_panel_page(panels, date_range=None, columns=2, panel_width=400, panel_height=220):
+    """
+    Renders several small streamflow charts tiled into a single PNG image.
+    :param panels: list of (title, dates, values) tuples, one per chart.
+    :param date_range: (start, end) dates shared by every panel's x axis. Defaults to the range covering all panels.
+    :param columns: number of panels per row.
+    """
+    if date_range is None:
+        starts = [np.asarray(dates, dtype='datetime64[D]').min() for _, dates, _ in panels if len(dates)]
+        ends = [np.asarray(dates, dtype='datetime64[D]').max() for _, dates, _ in panels if len(dates)]
+        date_range = (min(starts), max(ends)) if starts else None
+
+    rows = max(1, math.ceil(len(panels) / columns))
+    image = Image.new('RGB', (columns * panel_width, rows * panel_height), BACKGROUND)
+    for i, (title, dates, values) in enumerate(panels):
+        left = (i % columns) * panel_width
+        top = (i // columns) * panel_height
+        draw_line_chart(image, (left, top, left + panel_width, top + panel_height), title, dates, values,
+                        y_label='CFS', date_range=date_range)
+    return to_png(image)
+
+
+def to_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=False)
+    return buffer.getvalue()
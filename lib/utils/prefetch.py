@@ -0,0 +1,44 @@
+import asyncio
+import logging
+
+from .get_cfs_data import get_daily_site_data
+from .render_pool import render_line_charts
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to debug
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+
+# create formatter
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# add formatter to ch
+ch.setFormatter(formatter)
+
+# add ch to logger
+logger.addHandler(ch)
+
+
+async def _warm_chunk(semaphore, station_ids, backend):
+    async with semaphore:
+        try:
+            series_list = await get_daily_site_data(station_ids, revise=True)
+            await render_line_charts(series_list, backend=backend)
+        except Exception:
+            logger.exception(f'Failed to prefetch stations {station_ids}')
+
+
+async def warm_stations(station_ids, chunk_size=100, concurrency=4, backend='pillow'):
+    """
+    Fetches the latest values for the given stations in multi-site chunks, along with USGS revisions of their recent
+    provisional values, and renders their charts into the chart cache so later reports are served from warm data.
+    :param chunk_size: number of stations fetched together in one request.
+    :param concurrency: number of chunks fetched and rendered at the same time.
+    """
+    logger.debug(f'Prefetching {len(station_ids)} stations')
+    semaphore = asyncio.Semaphore(concurrency)
+    chunks = [station_ids[i:i + chunk_size] for i in range(0, len(station_ids), chunk_size)]
+    await asyncio.gather(*(_warm_chunk(semaphore, chunk, backend) for chunk in chunks))
+    logger.debug(f'Finished prefetching {len(station_ids)} stations')
@@ -0,0 +1,134 @@
+import re
+from array import array
+from collections import namedtuple
+
+# Comment lines listing the sites in a response, e.g. "#    USGS 09234500 GREEN RIVER NEAR GREENDALE, UT"
+SITE_NAME_LINE = re.compile(r'^#\s+USGS\s+(\d+)\s+(.+?)\s*$')
+
+RdbSeries = namedtuple('RdbSeries', ['site_no', 'site_name', 'dates', 'values', 'qualifiers'])
+
+
+class RdbParser(object):
+    """
+    Incremental parser for the NWIS RDB (tab delimited) format. Lines are fed in as they arrive and each station's
+    daily values are returned as soon as its block of rows is complete, so only one station is held in memory at a
+    time.
+    """
+
+    def __init__(self, parameter_cd='00060', statistic_cd='00003'):
+        self.column_suffix = f'_{parameter_cd}_{statistic_cd}'
+        self.site_names = {}
+        self._site_column = None
+        self._date_column = None
+        self._value_column = None
+        self._qualifier_column = None
+        self._skip_format_line = False
+        self._current = None
+
+    def _finish(self):
+        series, self._current = self._current, None
+        return [series] if series is not None and series.dates else []
+
+    def _read_header(self, fields):
+        self._site_column = fields.index('site_no')
+        self._date_column = fields.index('datetime')
+        self._value_column = next((i for i, name in enumerate(fields) if name.endswith(self.column_suffix)), None)
+        self._qualifier_column = None
+        if self._value_column is not None and f'{fields[self._value_column]}_cd' in fields:
+            self._qualifier_column = fields.index(f'{fields[self._value_column]}_cd')
+        # Every header is followed by a line describing the column widths and types
+        self._skip_format_line = True
+
+    def feed(self, line):
+        """
+        Parses a single line of an RDB response.
+        :return: list of RdbSeries completed by this line
+        """
+        line = line.rstrip('\r\n')
+        if not line:
+            return []
+
+        if line.startswith('#'):
+            match = SITE_NAME_LINE.match(line)
+            if match:
+                self.site_names[match.group(1)] = match.group(2)
+            return []
+
+        fields = line.split('\t')
+        if fields[0] == 'agency_cd':
+            completed = self._finish()
+            self._read_header(fields)
+            return completed
+
+        if self._skip_format_line:
+            self._skip_format_line = False
+            return []
+
+        if self._value_column is None or len(fields) <= self._value_column:
+            return []
+
+        completed = []
+        site_no = fields[self._site_column]
+        if self._current is None or self._current.site_no != site_no:
+            completed = self._finish()
+            self._current = RdbSeries(site_no, self.site_names.get(site_no), [], array('d'), [])
+
+        try:
+            value = float(fields[self._value_column])
+        except ValueError:
+            # Missing values are reported with codes such as "Ice" or "Eqp" instead of a number
+            return completed
+        self._current.dates.append(fields[self._date_column])
+        self._current.values.append(value)
+        self._current.qualifiers.append(fields[self._qualifier_column].replace(':', ',')
+                                        if self._qualifier_column is not None else '')
+        return completed
+
+    def close(self):
+        """
+        Finishes parsing and returns the last station's series.
+        """
+        return self._finish()
+
+
+async def parse_rdb_table(stream):
+    """
+    Asynchronously yields each row of a single-table RDB response (such as the site service's) as a dict of column
+    name to value, as the rows arrive on the given aiohttp response stream.
+    """
+    columns = None
+    skip_format_line = False
+    async for line in stream:
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if columns is None:
+            columns = fields
+            skip_format_line = True
+        elif skip_format_line:
+            skip_format_line = False
+        else:
+            yield dict(zip(columns, fields))
+
+
+def parse_rdb(lines, parameter_cd='00060', statistic_cd='00003'):
+    """
+    Yields an RdbSeries for each station found in the given lines of RDB text.
+    """
+    parser = RdbParser(parameter_cd, statistic_cd)
+    for line in lines:
+        yield from parser.feed(line)
+    yield from parser.close()
+
+
+async def parse_rdb_stream(stream, parameter_cd='00060', statistic_cd='00003'):
+    """
+    Asynchronously yields an RdbSeries for each station as its rows arrive on the given aiohttp response stream.
+    """
+    parser = RdbParser(parameter_cd, statistic_cd)
+    async for line in stream:
+        for series in parser.feed(line.decode('utf-8')):
+            yield series
+    for series in parser.close():
+        yield series
@@ -0,0 +1,125 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from . import chart_cache, downsample, graph_cfs, metrics
+
+# How long series are thinned out before drawing, see downsample.METHODS
+DOWNSAMPLE_METHOD = 'minmax'
+
+_executor = None
+
+
+def configure(downsample_method=DOWNSAMPLE_METHOD):
+    global DOWNSAMPLE_METHOD
+    if downsample_method not in downsample.METHODS:
+        raise ValueError(f'Unknown downsampling method {downsample_method!r}, expected one of {downsample.METHODS}')
+    DOWNSAMPLE_METHOD = downsample_method
+
+
+def _warm_up(backend):
+    # Import the plotting stack once when the worker starts rather than on its first chart
+    from . import png_chart
+
+    if backend == 'bokeh':
+        import bokeh.io.export
+        import bokeh.plotting
+
+
+def _ping():
+    return True
+
+
+def start(workers=None, backend='pillow'):
+    """
+    Starts the pool of chart rendering worker processes.
+    :param workers: number of worker processes, defaults to the number of CPUs.
+    :param backend: chart backend whose imports are loaded when each worker starts.
+    """
+    global _executor
+    if _executor is not None:
+        return
+    # Workers are spawned rather than forked so they don't inherit the bot's event loop, sockets and threads
+    _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_warm_up, initargs=(backend,))
+    _executor.submit(_ping)
+
+
+def shutdown(wait=False):
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+    _executor = None
+
+
+async def render_line_chart(title, dates, cfs_values, backend='pillow'):
+    """
+    Renders a single line chart in a worker process and returns the PNG bytes.
+    """
+    if _executor is None:
+        start(backend=backend)
+    loop = asyncio.get_event_loop()
+    # Covers drawing and PNG export in the worker along with the time spent waiting for a free worker
+    with metrics.span('render_chart'):
+        return await loop.run_in_executor(_executor, graph_cfs.render_line_chart, title, dates, cfs_values,
+                                          backend)
+
+
+async def cached_line_chart(series, backend='pillow'):
+    """
+    Returns the chart for the given StationSeries from the chart cache, rendering it in a worker process on a miss.
+    Series with more points than the chart is wide are downsampled first, so only what can be drawn is sent to the
+    worker and hashed for the cache key.
+    """
+    series = downsample.downsample(series, graph_cfs.CHART_WIDTH, method=DOWNSAMPLE_METHOD)
+    key = chart_cache.chart_key(series.station_id, series.dates, series.values, series.site_name, backend,
+                                graph_cfs.CHART_WIDTH, graph_cfs.CHART_HEIGHT)
+    return await chart_cache.cache.get_or_render(
+        key, lambda: render_line_chart(series.site_name, series.dates, series.values, backend=backend))
+
+
+async def render_panel_page(series_list, columns=2, backend='pillow'):
+    """
+    Returns one tiled image of small charts for the given StationSeries, all sharing the same date axis, from the
+    chart cache or rendered in a worker process on a miss.
+    """
+    series_list = [downsample.downsample(series, graph_cfs.PANEL_WIDTH, method=DOWNSAMPLE_METHOD)
+                   for series in series_list]
+    date_range = graph_cfs.shared_date_range(series_list)
+    key = chart_cache.chart_key('panels', [], [], date_range and tuple(str(date) for date in date_range), columns,
+                                backend, graph_cfs.PANEL_WIDTH, graph_cfs.PANEL_HEIGHT,
+                                *(chart_cache.chart_key(series.station_id, series.dates, series.values,
+                                                        series.site_name) for series in series_list))
+    panels = [(series.site_name, series.dates, series.values) for series in series_list]
+    if _executor is None:
+        start(backend=backend)
+    loop = asyncio.get_event_loop()
+
+    async def render():
+        with metrics.span('render_panel_page'):
+            return await loop.run_in_executor(_executor, graph_cfs.render_panel_page, panels, date_range, columns,
+                                              backend)
+
+    return await chart_cache.cache.get_or_render(key, render)
+
+
+async def render_report_pages(series_list, per_page=6, columns=2, backend='pillow'):
+    """
+    Renders the given StationSeries as pages of tiled small charts, one image per page of per_page stations.
+    :return: list of PNG images as bytes
+    """
+    if backend not in graph_cfs.BACKENDS:
+        raise ValueError(f'Unknown chart backend {backend!r}, expected one of {graph_cfs.BACKENDS}')
+    return list(await asyncio.gather(*(render_panel_page(page, columns=columns, backend=backend)
+                                       for page in graph_cfs.paginate(series_list, per_page))))
+
+
+async def render_line_charts(series_list, backend='pillow'):
+    """
+    Renders a line chart for each of the given StationSeries, spreading the charts across the worker processes.
+    Charts that were already rendered from the same values are served from the chart cache.
+    :return: list of PNG images as bytes
+    """
+    if backend not in graph_cfs.BACKENDS:
+        raise ValueError(f'Unknown chart backend {backend!r}, expected one of {graph_cfs.BACKENDS}')
+    return list(await asyncio.gather(*(cached_line_chart(series, backend=backend) for series in series_list)))
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+def format_cfs(value):
+    """
+    Formats a CFS value for display, dropping the decimal point from whole numbers.
+    """
+    if value is None or np.isnan(value):
+        return 'N/A'
+    return f'{value:,.0f}' if float(value).is_integer() else f'{value:,.2f}'
+
+
+class StationSeries(object):
+    """
+    Daily streamflow values for a single station, held as NumPy arrays so charting and reporting code doesn't need
+    to walk per-point Python objects.
+    """
+    __slots__ = ('station_id', 'site_name', 'dates', 'values', 'qualifiers', 'stale')
+
+    def __init__(self, station_id, site_name, dates, values, qualifiers=None, stale=False):
+        """
+        :param station_id: integer USGS site number.
+        :param dates: sequence of ISO dates (or datetime64 values) for each daily value.
+        :param values: sequence of CFS values matching dates.
+        :param qualifiers: sequence of comma separated USGS qualification codes (e.g. 'P' or 'A,e') matching dates.
+        :param stale: True when USGS couldn't be reached and the values may be missing the latest days.
+        """
+        self.station_id = int(station_id)
+        self.site_name = site_name
+        self.dates = np.asarray(dates, dtype='datetime64[D]')
+        self.values = np.asarray(values, dtype=np.float64)
+        self.qualifiers = np.asarray(qualifiers if qualifiers is not None else [''] * len(self.dates), dtype=str)
+        self.stale = stale
+
+    @classmethod
+    def from_rows(cls, station_id, site_name, rows):
+        """
+        Builds a series from (date, value, qualifiers) rows such as those stored in the observations table.
+        """
+        if not rows:
+            return cls(station_id, site_name, [], [], [])
+        dates, values, qualifiers = zip(*rows)
+        return cls(station_id, site_name, dates, values, [q or '' for q in qualifiers])
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __repr__(self):
+        return f'<StationSeries {self.station_id} {self.site_name!r} ({len(self)} values)>'
+
+    @property
+    def latest_value(self):
+        return float(self.values[-1]) if len(self) else None
+
+    @property
+    def latest_date(self):
+        return self.dates[-1].item() if len(self) else None
+
+    @property
+    def is_provisional(self):
+        return bool(len(self)) and 'P' in self.qualifiers[-1].split(',')
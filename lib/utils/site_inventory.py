@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import re
+
+import aiohttp
+
+from . import rdb
+from .get_cfs_data import BASE_URL, get_session
+from ..db import db
+
+# States and territories the USGS site service is queried for, one request each
+STATE_CODES = (
+    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA',
+    'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR',
+    'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY', 'AS', 'GU', 'MP', 'PR', 'VI',
+)
+# Rows written to the database per batch while an import is streaming in
+BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to debug
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+
+# create formatter
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# add formatter to ch
+ch.setFormatter(formatter)
+
+# add ch to logger
+logger.addHandler(ch)
+
+
+async def _store_sites(rows):
+    await db.multiexec('INSERT OR REPLACE INTO sites (StationID, StationName, StateCd, HucCd, SiteType) '
+                       'VALUES (?, ?, ?, ?, ?)', rows)
+
+
+async def import_state(state_cd):
+    """
+    Imports every stream site in the given state that reports daily discharge values from the USGS site service.
+    :return: number of sites imported
+    """
+    # Only sites with daily discharge values can be reported on, so leave everything else out of the index
+    url = f'{BASE_URL}/site/?format=rdb&stateCd={state_cd}&parameterCd=00060&hasDataTypeCd=dv&siteType=ST' \
+          f'&siteStatus=all'
+    imported = 0
+    rows = []
+    try:
+        async with get_session().get(url) as response:
+            if response.status != 200:
+                logger.debug(f'USGS site request for {state_cd} returned status {response.status}')
+                return 0
+            async for site in rdb.parse_rdb_table(response.content):
+                rows.append((int(site['site_no']), site['station_nm'], state_cd, site.get('huc_cd'),
+                             site.get('site_tp_cd')))
+                if len(rows) >= BATCH_SIZE:
+                    await _store_sites(rows)
+                    imported, rows = imported + len(rows), []
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f'USGS site request for {state_cd} failed: {e!r}')
+    if rows:
+        await _store_sites(rows)
+        imported += len(rows)
+    return imported
+
+
+async def import_sites(states=STATE_CODES, concurrency=4):
+    """
+    Bulk imports the USGS site inventory for the given states into the local sites table and rebuilds its full
+    text index.
+    :return: total number of sites imported
+    """
+    logger.debug(f'Importing USGS site inventory for {len(states)} states')
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def import_limited(state_cd):
+        async with semaphore:
+            return await import_state(state_cd)
+
+    imported = sum(await asyncio.gather(*(import_limited(state_cd) for state_cd in states)))
+    await db.execute("INSERT INTO sites_fts (sites_fts) VALUES ('rebuild')")
+    logger.debug(f'Imported {imported} sites')
+    return imported
+
+
+async def index_size():
+    return await db.field('SELECT COUNT(*) FROM sites')
+
+
+def _match_query(text):
+    # Quote every word so user input can't be read as FTS syntax, and prefix match them so partial names match
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+async def find_sites(text, state_cd=None, limit=10):
+    """
+    Searches the local site index by station name.
+    :param state_cd: optional two letter state code to limit the search to.
+    :return: list of (StationID, StationName, StateCd) tuples, best matches first
+    """
+    query = _match_query(text)
+    if not query:
+        return []
+    if state_cd:
+        return await db.records('SELECT sites.StationID, sites.StationName, StateCd FROM sites_fts '
+                                'INNER JOIN sites ON sites.StationID = sites_fts.rowid '
+                                'WHERE sites_fts MATCH ? AND StateCd = ? ORDER BY rank LIMIT ?',
+                                query, state_cd.upper(), limit)
+    return await db.records('SELECT sites.StationID, sites.StationName, StateCd FROM sites_fts '
+                            'INNER JOIN sites ON sites.StationID = sites_fts.rowid '
+                            'WHERE sites_fts MATCH ? ORDER BY rank LIMIT ?', query, limit)